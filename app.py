@@ -1,146 +1,1194 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import time
 import random
-from PIL import Image
+import threading
+import hashlib
+import os
+import sqlite3
+import uuid
+import logging
+import html
 import io
-import base64
-import pandas as pd
-import streamlit_lottie as st_lottie
-
-# Set page configuration
-st.set_page_config(
-    page_title="ইন্টারেক্টিভ গল্প অ্যাডভেঞ্চার",  # Interactive Story Adventure in Bengali
-    page_icon="📖",
-    layout="centered",
-    initial_sidebar_state="expanded"
-)
-
-# Custom CSS for a clean, modern UI
-st.markdown("""
-<style>
-    @import url('https://fonts.googleapis.com/css2?family=Tiro+Bangla&display=swap');
-    
-    * {
-        font-family: 'Tiro Bangla', serif;
-    }
+import mmap
+import struct
+import sys
+import traceback
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+# Static assets (font and fallback image) served by Streamlit at app/static/ (see .streamlit/config.toml)
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(APP_DIR, "static")
+
+# Relative data paths are anchored at the app's directory, not the working directory,
+# so `streamlit run /path/app.py` from anywhere reads and writes the same files
+def app_path(path):
+    return os.path.join(APP_DIR, path)
+FONT_FILE = "fonts/TiroBangla-Regular.ttf"
+PLACEHOLDER_IMAGE = "placeholder.svg"
+
+PAGE_CSS = """
+        * {
+            font-family: 'Tiro Bangla', serif;
+        }
     
-    .main {
-        background-color: #f5f5f5;
-    }
-    .stButton > button {
-        width: 100%;
-        border-radius: 5px;
-        height: 3em;
-        font-weight: 500;
-        font-family: 'Tiro Bangla', serif;
-    }
-    .story-text {
-        background-color: white;
-        padding: 20px;
-        border-radius: 10px;
-        box-shadow: 0 4px 6px rgba(0, 0, 0, 0.1);
-        font-family: 'Tiro Bangla', serif;
-        font-size: 1.1em;
-        line-height: 1.6;
-    }
-    .choice-button {
-        margin-top: 10px;
-    }
-    h1, h2, h3 {
-        color: #1E1E1E;
-        font-family: 'Tiro Bangla', serif;
-    }
-    .footer {
-        margin-top: 30px;
-        text-align: center;
-        color: #888888;
-        font-family: 'Tiro Bangla', serif;
-    }
-    .stTextInput > div > div > input {
-        font-family: 'Tiro Bangla', serif;
-    }
-    .stSelectbox > div > div > div {
-        font-family: 'Tiro Bangla', serif;
-    }
-    p, span, label, div {
-        font-family: 'Tiro Bangla', serif;
-    }
-</style>
-""", unsafe_allow_html=True)
+        .main {
+            background-color: #f5f5f5;
+        }
+        .stButton > button {
+            width: 100%;
+            border-radius: 5px;
+            height: 3em;
+            font-weight: 500;
+            font-family: 'Tiro Bangla', serif;
+        }
+        .story-text {
+            background-color: white;
+            padding: 20px;
+            border-radius: 10px;
+            box-shadow: 0 4px 6px rgba(0, 0, 0, 0.1);
+            font-family: 'Tiro Bangla', serif;
+            font-size: 1.1em;
+            line-height: 1.6;
+        }
+        .choice-button {
+            margin-top: 10px;
+        }
+        h1, h2, h3 {
+            color: #1E1E1E;
+            font-family: 'Tiro Bangla', serif;
+        }
+        .footer {
+            margin-top: 30px;
+            text-align: center;
+            color: #888888;
+            font-family: 'Tiro Bangla', serif;
+        }
+        .stTextInput > div > div > input {
+            font-family: 'Tiro Bangla', serif;
+        }
+        .stSelectbox > div > div > div {
+            font-family: 'Tiro Bangla', serif;
+        }
+        p, span, label, div {
+            font-family: 'Tiro Bangla', serif;
+        }
+"""
+
+# Build the page styles once per process: the self-hosted font from static/, falling back to
+# the Google Fonts stylesheet only when the font file is missing from the deployment
+@st.cache_resource
+def page_css():
+    if os.path.exists(os.path.join(STATIC_DIR, FONT_FILE)):
+        font = ("@font-face { font-family: 'Tiro Bangla'; font-display: swap; "
+                f"src: local('Tiro Bangla'), url('app/static/{FONT_FILE}') format('truetype'); }}")
+    else:
+        font = "@import url('https://fonts.googleapis.com/css2?family=Tiro+Bangla&display=swap');"
+    # Collapse the whitespace so each full run sends as few bytes as possible
+    rules = " ".join(line.strip() for line in PAGE_CSS.splitlines() if line.strip())
+    return f"<style>{font} {rules}</style>"
+
+# Page configuration and styling. Streamlit drops elements a run does not re-emit, so the
+# styles go out on every full-app run; choice clicks only rerun the story fragment
+def setup_page():
+    # Set page configuration
+    st.set_page_config(
+        page_title="ইন্টারেক্টিভ গল্প অ্যাডভেঞ্চার",  # Interactive Story Adventure in Bengali
+        page_icon="📖",
+        layout="centered",
+        initial_sidebar_state="expanded"
+    )
+
+    # Custom CSS for a clean, modern UI
+    st.markdown(page_css(), unsafe_allow_html=True)
+
+# Lottie animation sources per genre
+LOTTIE_URLS = {
+    "adventure": "https://assets6.lottiefiles.com/packages/lf20_bXmwcH6RUo.json",
+    "horror": "https://assets6.lottiefiles.com/packages/lf20_kcxosgub.json",
+    "romance": "https://assets6.lottiefiles.com/packages/lf20_khrclx93.json",
+    "fantasy": "https://assets9.lottiefiles.com/packages/lf20_hk63n9i9.json",
+    "mystery": "https://assets7.lottiefiles.com/packages/lf20_rdkby0a0.json",
+    "sci_fi": "https://assets7.lottiefiles.com/packages/lf20_xUSzvwkTmz.json",
+}
+
+# Animations are kept on disk next to a manifest of their SHA-256 digests
+def lottie_dir():
+    return app_path(get_setting("dir", "assets/lottie", section="lottie"))
+
+def read_lottie_manifest():
+    try:
+        with open(os.path.join(lottie_dir(), "manifest.json"), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+@st.cache_resource
+def get_lottie_manifest_lock():
+    return threading.Lock()
+
+# Write a file atomically so concurrent readers never see a partial animation
+def write_file_atomic(path, data):
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+# Round coordinates and drop editor metadata; the result renders the same at a fraction of the size
+def minify_lottie(data, precision=3):
+    if isinstance(data, dict):
+        return {key: minify_lottie(value, precision) for key, value in data.items() if key not in ("meta", "markers")}
+    if isinstance(data, list):
+        return [minify_lottie(value, precision) for value in data]
+    if isinstance(data, float):
+        return round(data, precision)
+    return data
+
+# Function to download one animation into the disk cache, with timeouts
+def fetch_lottie(genre):
+    url = LOTTIE_URLS[genre]
+    timeout = (float(get_setting("connect_timeout", 3.0, section="lottie")),
+               float(get_setting("read_timeout", 10.0, section="lottie")))
+    r = requests.get(url, timeout=timeout)
+    r.raise_for_status()
+    raw = r.content
+    data = json.loads(raw)
+    minified = json.dumps(minify_lottie(data), separators=(",", ":")).encode("utf-8")
+
+    directory = lottie_dir()
+    os.makedirs(directory, exist_ok=True)
+    write_file_atomic(os.path.join(directory, f"{genre}.json"), raw)
+    write_file_atomic(os.path.join(directory, f"{genre}.min.json"), minified)
+    with get_lottie_manifest_lock():
+        manifest = read_lottie_manifest()
+        manifest[genre] = {
+            "url": url,
+            "sha256": hashlib.sha256(raw).hexdigest(),
+            "min_sha256": hashlib.sha256(minified).hexdigest(),
+        }
+        write_file_atomic(os.path.join(directory, "manifest.json"),
+                          json.dumps(manifest, indent=2, sort_keys=True).encode("utf-8"))
+    return data
+
+# Read a cached animation, rejecting files that do not match the manifest
+def read_cached_lottie(genre, light):
+    entry = read_lottie_manifest().get(genre)
+    if not entry or entry.get("url") != LOTTIE_URLS[genre]:
+        return None
+    filename, digest = (f"{genre}.min.json", entry.get("min_sha256")) if light else (f"{genre}.json", entry.get("sha256"))
+    try:
+        with open(os.path.join(lottie_dir(), filename), "rb") as f:
+            raw = f.read()
+    except OSError:
+        return None
+    if hashlib.sha256(raw).hexdigest() != digest:
+        return None
+    return json.loads(raw)
+
+# Download every missing or stale animation in parallel; returns the genres worth trying again
+def refresh_lotties(genres=None):
+    genres = [genre for genre in (genres or LOTTIE_URLS) if read_cached_lottie(genre, light=False) is None]
+    if not genres:
+        return []
+    retry = []
+    with ThreadPoolExecutor(max_workers=len(genres), thread_name_prefix="lottie") as executor:
+        futures = {genre: executor.submit(fetch_lottie, genre) for genre in genres}
+        for genre, future in futures.items():
+            try:
+                future.result()
+            except requests.HTTPError as e:
+                # A 4xx will not fix itself; the start screen shows the placeholder image instead
+                if e.response is not None and e.response.status_code < 500:
+                    logger.warning("Animation for '%s' is unavailable: %s", genre, e)
+                else:
+                    retry.append(genre)
+            except Exception:
+                retry.append(genre)
+    return retry
+
+def lottie_retry_interval():
+    return float(get_setting("retry_interval", 30.0, section="lottie"))
+
+# Retry failed downloads with exponential backoff, up to max_attempts, while the CDN is down
+def refresh_lotties_until_cached():
+    attempts = int(get_setting("max_attempts", 6, section="lottie"))
+    genres = None
+    for attempt in range(attempts):
+        genres = refresh_lotties(genres)
+        if not genres:
+            return
+        if attempt + 1 < attempts:
+            time.sleep(min(lottie_retry_interval() * 2 ** attempt, 3600.0))
+    logger.warning("Giving up on animations for: %s", ", ".join(genres))
+
+# Refresh the disk cache once per process without blocking the first page
+@st.cache_resource
+def start_lottie_refresh():
+    thread = threading.Thread(target=refresh_lotties_until_cached, name="lottie-refresh", daemon=True)
+    thread.start()
+    return thread
+
+# Failures raise so they are not cached and a later rerun sees the file once the refresh lands
+@st.cache_resource(max_entries=len(LOTTIE_URLS) * 2)
+def _load_lottie(genre, light):
+    data = read_cached_lottie(genre, light)
+    if data is None:
+        raise FileNotFoundError(f"Animation for '{genre}' is unavailable")
+    return data
+
+# Recent misses per (genre, light), so reruns within the retry interval skip the disk check
+@st.cache_resource
+def get_lottie_misses():
+    return {}
 
-# Function to load Lottie animations
-def load_lottieurl(url):
-    r = requests.get(url)
-    if r.status_code != 200:
+# Load one genre's animation from the disk cache; downloading is left to the background refresh
+def load_lottie(genre, light=False):
+    if genre not in LOTTIE_URLS:
+        return None
+    misses = get_lottie_misses()
+    missed_at = misses.get((genre, light))
+    if missed_at is not None and time.monotonic() - missed_at < lottie_retry_interval():
+        return None
+    try:
+        data = _load_lottie(genre, light)
+    except Exception:
+        misses[(genre, light)] = time.monotonic()
         return None
-    return r.json()
+    misses.pop((genre, light), None)
+    return data
+
+# Gemini API endpoint and the status codes worth retrying
+GEMINI_API_BASE = "https://generativelanguage.googleapis.com/v1beta"
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Story genres offered on the start screen
+GENRE_OPTIONS = {
+    "adventure": "অ্যাডভেঞ্চার 🏞️",  # Adventure in Bengali
+    "horror": "হরর 👻",  # Horror in Bengali
+    "romance": "রোমান্স ❤️",  # Romance in Bengali
+    "fantasy": "ফ্যান্টাসি 🧙‍♂️",  # Fantasy in Bengali
+    "mystery": "মিস্টেরি 🔍",  # Mystery in Bengali
+    "sci_fi": "সায়েন্স ফিকশন 🚀"  # Science Fiction in Bengali
+}
+
+# Number of decisions before the story concludes
+MAX_DECISIONS = 20
+
+# Prefix of the placeholder text generate_story returns when a request fails
+ERROR_PREFIX = "Error generating story."
+
+logger = logging.getLogger(__name__)
+
+# Background workers have no Streamlit script context, so they must not write to the page.
+# Streamlit re-executes this script on every rerun, so the thread-local is created through
+# st.cache_resource to stay the same object that long-lived worker threads were given.
+@st.cache_resource
+def get_worker_state():
+    return threading.local()
+
+_worker_state = get_worker_state()
+
+def in_background():
+    return getattr(_worker_state, "background", False)
+
+# Session the current thread is working for, used to share the API quota fairly
+def current_session_id():
+    return getattr(_worker_state, "session_id", None) or "anonymous"
+
+def is_error_text(text):
+    return text.startswith(ERROR_PREFIX)
+
+# Read an optional setting from Streamlit secrets, falling back to a default
+def get_setting(key, default=None, section="gemini"):
+    try:
+        return st.secrets[section].get(key, default)
+    except Exception:
+        return default
+
+class GeminiError(Exception):
+    pass
+
+class GeminiClient:
+    """Shared Gemini client with a bounded keep-alive connection pool."""
+
+    def __init__(self, api_key, api_base=GEMINI_API_BASE, connect_timeout=5.0, read_timeout=60.0,
+                 max_retries=3, backoff_base=0.5, backoff_max=8.0, max_connections=10, before_retry=None):
+        self.api_key = api_key
+        # Called with the payload before every re-sent attempt, so retries are metered too
+        self.before_retry = before_retry
+        self.api_base = api_base.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        # pool_block makes callers wait for a free connection instead of opening more
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections, pool_block=True, max_retries=0)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "Content-Type": "application/json",
+            "x-goog-api-key": api_key,
+        })
+
+    # Full-jitter exponential backoff, honouring Retry-After when the server sends one
+    def _backoff_delay(self, attempt, response=None):
+        if response is not None:
+            retry_after = response.headers.get("Retry-After")
+            if retry_after and retry_after.isdigit():
+                return min(float(retry_after), self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    # POST with retries; streamed responses are only retried before the body is read
+    # `info`, when given, receives the final HTTP status, the retry count and the time to first byte
+    def _post(self, url, payload, params=None, stream=False, info=None):
+        info = {} if info is None else info
+        for attempt in range(self.max_retries + 1):
+            info["retries"] = attempt
+            if attempt and self.before_retry is not None:
+                self.before_retry(payload)
+            try:
+                response = self.session.post(url, params=params, json=payload, timeout=self.timeout, stream=stream)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                info["status"] = 0
+                if attempt >= self.max_retries:
+                    raise GeminiError(f"API request failed after {attempt + 1} attempts: {str(e)}")
+                time.sleep(self._backoff_delay(attempt))
+                continue
+
+            info["status"] = response.status_code
+            # requests measures elapsed time up to the parsed response headers
+            info["ttfb"] = response.elapsed.total_seconds()
+            if response.status_code == 200:
+                return response
+
+            # Read the error body before releasing the connection back to the pool
+            detail = response.text
+            response.close()
+            if response.status_code in RETRYABLE_STATUS_CODES and attempt < self.max_retries:
+                time.sleep(self._backoff_delay(attempt, response))
+                continue
+
+            raise GeminiError(f"API request failed with status code: {response.status_code}, response: {detail}")
+
+    def generate_content(self, model, payload, info=None):
+        url = f"{self.api_base}/models/{model}:generateContent"
+        return self._post(url, payload, info=info).json()
+
+    # Yield each server-sent event of a streamGenerateContent response as parsed JSON
+    def stream_generate_content(self, model, payload, info=None):
+        url = f"{self.api_base}/models/{model}:streamGenerateContent"
+        response = self._post(url, payload, params={"alt": "sse"}, stream=True, info=info)
+        with response:
+            # chunk_size=None hands over each transfer chunk as it arrives instead of waiting for 512 bytes
+            for line in response.iter_lines(chunk_size=None):
+                # SSE bodies are UTF-8 regardless of what requests guesses from the headers
+                line = line.decode("utf-8")
+                if line.startswith("data:"):
+                    yield json.loads(line[len("data:"):].strip())
+
+# Build the Gemini client once per process so every session shares its connection pool
+@st.cache_resource
+def get_gemini_client():
+    return GeminiClient(
+        api_key=st.secrets["gemini"]["api_key"],
+        api_base=get_setting("api_base", GEMINI_API_BASE),
+        connect_timeout=float(get_setting("connect_timeout", 5.0)),
+        read_timeout=float(get_setting("read_timeout", 60.0)),
+        max_retries=int(get_setting("max_retries", 3)),
+        backoff_base=float(get_setting("backoff_base", 0.5)),
+        backoff_max=float(get_setting("backoff_max", 8.0)),
+        max_connections=int(get_setting("max_connections", 10)),
+        before_retry=lambda payload: get_dispatcher().charge_retry(
+            estimate_tokens(payload["contents"][0]["parts"][0]["text"])),
+    )
+
+# Minimal Prometheus-style registry: labelled counters and histograms, plus values read on scrape
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 15.0, 30.0, 60.0)
+TOKEN_BUCKETS = (250, 500, 1000, 2000, 4000, 8000, 16000, 32000)
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._help = {}
+        self._buckets = {}
+
+    @staticmethod
+    def _labels(labels):
+        return tuple(sorted((key, str(value)) for key, value in (labels or {}).items()))
+
+    def inc(self, name, labels=None, value=1, help_text=""):
+        key = self._labels(labels)
+        with self._lock:
+            self._help.setdefault(name, help_text)
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, labels=None, help_text="", buckets=LATENCY_BUCKETS):
+        key = self._labels(labels)
+        with self._lock:
+            self._help.setdefault(name, help_text)
+            bounds = self._buckets.setdefault(name, buckets)
+            series = self._histograms.setdefault(name, {})
+            counts, total, count = series.get(key, ([0] * len(bounds), 0.0, 0))
+            counts = [n + (value <= bound) for n, bound in zip(counts, bounds)]
+            series[key] = (counts, total + value, count + 1)
+
+    # `read` is called on every scrape; kind="counter" for values that only ever grow
+    def gauge(self, name, read, help_text="", kind="gauge"):
+        with self._lock:
+            self._help.setdefault(name, help_text)
+            self._gauges[name] = (read, kind)
+
+    @staticmethod
+    def _format(name, labels, value, extra=()):
+        pairs = ",".join(f'{key}="{val}"' for key, val in tuple(labels) + tuple(extra))
+        return f"{name}{{{pairs}}} {value}" if pairs else f"{name} {value}"
+
+    # Text exposition format understood by Prometheus
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                lines += [f"# HELP {name} {self._help[name]}", f"# TYPE {name} counter"]
+                lines += [self._format(name, labels, value) for labels, value in series.items()]
+            for name, series in sorted(self._histograms.items()):
+                lines += [f"# HELP {name} {self._help[name]}", f"# TYPE {name} histogram"]
+                for labels, (buckets, total, count) in series.items():
+                    for bound, n in zip(self._buckets[name], buckets):
+                        lines.append(self._format(f"{name}_bucket", labels, n, [("le", str(bound))]))
+                    lines.append(self._format(f"{name}_bucket", labels, count, [("le", "+Inf")]))
+                    lines.append(self._format(f"{name}_sum", labels, round(total, 6)))
+                    lines.append(self._format(f"{name}_count", labels, count))
+            gauges = list(self._gauges.items())
+        for name, (read, kind) in sorted(gauges):
+            try:
+                value = read()
+            except Exception:
+                continue
+            lines += [f"# HELP {name} {self._help[name]}", f"# TYPE {name} {kind}", f"{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+@st.cache_resource
+def get_metrics():
+    return Metrics()
+
+# One JSON object per line on the "story.metrics" logger
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"ts": round(record.created, 3), "level": record.levelname, "event": record.getMessage()}
+        entry.update(getattr(record, "fields", {}))
+        return json.dumps(entry, ensure_ascii=False)
 
-# Cache the Lottie animations
 @st.cache_resource
-def get_lotties():
-    lotties = {
-        "adventure": load_lottieurl("https://assets6.lottiefiles.com/packages/lf20_bXmwcH6RUo.json"),
-        "horror": load_lottieurl("https://assets6.lottiefiles.com/packages/lf20_kcxosgub.json"),
-        "romance": load_lottieurl("https://assets6.lottiefiles.com/packages/lf20_khrclx93.json"),
-        "fantasy": load_lottieurl("https://assets9.lottiefiles.com/packages/lf20_hk63n9i9.json"),
-        "mystery": load_lottieurl("https://assets7.lottiefiles.com/packages/lf20_rdkby0a0.json"),
-        "sci_fi": load_lottieurl("https://assets7.lottiefiles.com/packages/lf20_xUSzvwkTmz.json"),
+def get_metrics_logger():
+    metrics_logger = logging.getLogger("story.metrics")
+    if get_setting("json_logs", True, section="metrics"):
+        handler = logging.StreamHandler()
+        handler.setFormatter(JsonLogFormatter())
+        metrics_logger.addHandler(handler)
+        metrics_logger.setLevel(logging.INFO)
+        metrics_logger.propagate = False
+    return metrics_logger
+
+def log_event(event, **fields):
+    get_metrics_logger().info(event, extra={"fields": fields})
+
+# Record one upstream call (also used for calls that failed before any response)
+def record_llm_call(metrics, metrics_logger, prompt_type, model, seconds, info, usage=None, stream=False):
+    labels = {"prompt_type": prompt_type or "other", "model": model}
+    status = info.get("status", 0)
+    metrics.inc("story_llm_requests_total", dict(labels, status=status), help_text="Upstream Gemini calls")
+    metrics.observe("story_llm_request_seconds", seconds, labels, help_text="Wall time of upstream Gemini calls")
+    if "ttfb" in info:
+        metrics.observe("story_llm_ttfb_seconds", info["ttfb"], labels, help_text="Time to first byte of upstream Gemini calls")
+    if info.get("retries"):
+        metrics.inc("story_llm_retries_total", labels, info["retries"], help_text="Retried upstream Gemini attempts")
+    usage = usage or {}
+    for kind, field in (("prompt", "promptTokenCount"), ("candidates", "candidatesTokenCount")):
+        if usage.get(field):
+            metrics.inc("story_llm_tokens_total", dict(labels, kind=kind), usage[field], help_text="Tokens reported by usageMetadata")
+    metrics_logger.info("llm_call", extra={"fields": {
+        "prompt_type": labels["prompt_type"], "model": model, "seconds": round(seconds, 4),
+        "ttfb": round(info["ttfb"], 4) if "ttfb" in info else None, "status": status,
+        "retries": info.get("retries", 0), "stream": stream,
+        "prompt_tokens": usage.get("promptTokenCount"), "candidate_tokens": usage.get("candidatesTokenCount"),
+    }})
+
+# Statistical profiler: samples every thread's stack and counts collapsed stacks (flame graph input)
+class SamplingProfiler:
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = {}
+        self._lock = threading.Lock()
+        threading.Thread(target=self._run, name="sampling-profiler", daemon=True).start()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while True:
+            time.sleep(self.interval)
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = ";".join(f"{entry.name} ({os.path.basename(entry.filename)}:{entry.lineno})"
+                                 for entry in traceback.extract_stack(frame))
+                with self._lock:
+                    self.samples[stack] = self.samples.get(stack, 0) + 1
+
+    def collapsed(self):
+        with self._lock:
+            return "".join(f"{stack} {count}\n" for stack, count in sorted(self.samples.items(), key=lambda item: -item[1]))
+
+# Serve /metrics (and /profile when the profiler is on) from a small side server, once per process
+@st.cache_resource
+def start_metrics_server():
+    # Off unless asked for, and local-only by default: the endpoint has no authentication
+    if not get_setting("enabled", False, section="metrics"):
+        return None
+    # Imported here so cold starts without the endpoint skip http.server
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    metrics = get_metrics()
+    dispatcher = get_dispatcher()
+    metrics.gauge("story_dispatcher_queue_depth", dispatcher.queue_depth, help_text="Requests waiting in the shared dispatcher")
+    cache = get_llm_cache()
+    metrics.gauge("story_cache_hits_total", lambda: sum(cache.stats()[key] for key in ("memory_hits", "disk_hits")),
+                  help_text="LLM cache hits", kind="counter")
+    metrics.gauge("story_cache_misses_total", lambda: cache.stats()["misses"], help_text="LLM cache misses", kind="counter")
+    profiler = None
+    if get_setting("enabled", False, section="profiler"):
+        profiler = SamplingProfiler(interval=1.0 / float(get_setting("hz", 100, section="profiler")))
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path == "/metrics":
+                body, content_type = metrics.render(), "text/plain; version=0.0.4"
+            elif self.path == "/profile" and profiler is not None:
+                body, content_type = profiler.collapsed(), "text/plain"
+            else:
+                self.send_error(404)
+                return
+            data = body.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    try:
+        server = ThreadingHTTPServer((get_setting("host", "127.0.0.1", section="metrics"),
+                                      int(get_setting("port", 9464, section="metrics"))), Handler)
+    except OSError as e:
+        # Another replica on this host may already own the port; metrics are optional
+        logger.warning("Metrics endpoint disabled: %s", e)
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
+
+# Content-addressed response cache: a bounded in-process LRU in front of a SQLite file
+class LLMCache:
+    def __init__(self, path=None, memory_items=256, ttl_seconds=86400, max_rows=5000):
+        self.memory_items = memory_items
+        self.ttl_seconds = ttl_seconds
+        self.max_rows = max_rows
+        self.hits = {"memory": 0, "disk": 0}
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._puts = 0
+
+        self._db = None
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+            self._db.commit()
+
+    @staticmethod
+    def make_key(model, prompt, params=None):
+        material = json.dumps([model, prompt, params or {}], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and now - entry[1] < self.ttl_seconds:
+                self._memory.move_to_end(key)
+                self.hits["memory"] += 1
+                return entry[0]
+            self._memory.pop(key, None)
+
+            if self._db is not None:
+                row = self._db.execute("SELECT value, created FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None and now - row[1] < self.ttl_seconds:
+                    self._db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+                    self._db.commit()
+                    self._remember(key, row[0], row[1])
+                    self.hits["disk"] += 1
+                    return row[0]
+
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._remember(key, value, now)
+            if self._db is None:
+                return
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, value, now, now)
+            )
+            self._puts += 1
+            # Evicting on every write would dominate the cost of small inserts
+            if self._puts % 50 == 0:
+                self._evict(now)
+            self._db.commit()
+
+    def _remember(self, key, value, created):
+        self._memory[key] = (value, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    # Drop expired rows, then the least recently used ones beyond max_rows
+    def _evict(self, now):
+        self._db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl_seconds,))
+        self._db.execute(
+            "DELETE FROM responses WHERE key IN "
+            "(SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+            (self.max_rows,)
+        )
+
+    def stats(self):
+        with self._lock:
+            return {
+                "memory_hits": self.hits["memory"],
+                "disk_hits": self.hits["disk"],
+                "misses": self.misses,
+                "memory_items": len(self._memory),
+            }
+
+@st.cache_resource
+def get_llm_cache():
+    return LLMCache(
+        path=app_path(get_setting("path", ".cache/llm_cache.sqlite3", section="cache")),
+        memory_items=int(get_setting("memory_items", 256, section="cache")),
+        ttl_seconds=float(get_setting("ttl_seconds", 86400, section="cache")),
+        max_rows=int(get_setting("max_rows", 5000, section="cache")),
+    )
+
+# Only prompt types listed in the cache settings are cached (personalised continuations are not)
+def cache_for(prompt_type):
+    if not get_setting("enabled", True, section="cache"):
+        return None
+    if prompt_type not in get_setting("prompt_types", ["opening", "conclusion"], section="cache"):
+        return None
+    return get_llm_cache()
+
+# Prompt types that ask for a fresh sample on every call; identical requests must not share an answer
+UNSHARED_PROMPT_TYPES = {"opening_pool", "summary"}
+
+class DispatcherBusy(GeminiError):
+    pass
+
+# Rough token estimate used for rate limiting before the real usage is known
+def estimate_tokens(text):
+    return max(1, len(text) // 3)
+
+# Token bucket refilled continuously at a per-minute rate (0 disables the limit)
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / 60.0)
+        self.updated = now
+
+    # Seconds until `amount` tokens are available
+    def wait_time(self, amount):
+        if self.capacity <= 0:
+            return 0.0
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) * 60.0 / self.capacity
+
+    def consume(self, amount):
+        if self.capacity > 0:
+            self._refill()
+            self.tokens -= amount
+
+# Process-wide gate in front of the Gemini API key shared by every session.
+# Identical in-flight requests are collapsed into one upstream call, requests and tokens per
+# minute are metered with token buckets, and queued work is served round-robin by session.
+class GeminiDispatcher:
+    def __init__(self, requests_per_minute=0, tokens_per_minute=0, max_backlog=100, workers=8):
+        self.max_backlog = max_backlog
+        self._requests = TokenBucket(requests_per_minute)
+        self._tokens = TokenBucket(tokens_per_minute)
+        self._queues = OrderedDict()
+        self._inflight = {}
+        self._backlog = 0
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="gemini")
+        threading.Thread(target=self._schedule, name="gemini-dispatcher", daemon=True).start()
+
+    def queue_depth(self):
+        with self._cond:
+            return self._backlog
+
+    # Queue `fn` and return a Future; a key already in flight shares the existing Future
+    def submit(self, key, session_id, fn, cost_tokens=1):
+        with self._cond:
+            if key is not None and key in self._inflight:
+                return self._inflight[key]
+            if self._backlog >= self.max_backlog:
+                raise DispatcherBusy(f"Request queue is full ({self._backlog} waiting)")
+
+            future = Future()
+            if key is not None:
+                self._inflight[key] = future
+            self._queues.setdefault(session_id, deque()).append((key, fn, cost_tokens, future))
+            self._backlog += 1
+            self._cond.notify()
+            return future
+
+    # Wait for a rate-limit slot without running anything (used by streaming requests)
+    def acquire(self, session_id, cost_tokens=1):
+        self.submit(None, session_id, lambda: None, cost_tokens).result()
+
+    # Take a rate-limit slot only if one is free right now (used for optional hedge requests)
+    def try_acquire(self, cost_tokens=1):
+        with self._cond:
+            if self._requests.wait_time(1) > 0 or self._tokens.wait_time(cost_tokens) > 0:
+                return False
+            self._requests.consume(1)
+            self._tokens.consume(cost_tokens)
+            return True
+
+    # Block until the buckets have room for a re-sent attempt, then charge it. Retries of a
+    # request that already left the queue continue ahead of it rather than queueing again
+    def charge_retry(self, cost_tokens=1):
+        with self._cond:
+            while True:
+                delay = max(self._requests.wait_time(1), self._tokens.wait_time(cost_tokens))
+                if delay <= 0:
+                    break
+                self._cond.wait(delay)
+            self._requests.consume(1)
+            self._tokens.consume(cost_tokens)
+
+    # Charge the difference once the real token usage of a request is known
+    def reconcile(self, estimated_tokens, actual_tokens):
+        if actual_tokens:
+            with self._cond:
+                self._tokens.consume(actual_tokens - estimated_tokens)
+
+    def _schedule(self):
+        while True:
+            with self._cond:
+                while not self._queues:
+                    self._cond.wait()
+
+                # The session at the head of the rotation goes next
+                session_id, queue = next(iter(self._queues.items()))
+                key, fn, cost_tokens, future = queue[0]
+                delay = max(self._requests.wait_time(1), self._tokens.wait_time(cost_tokens))
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+
+                queue.popleft()
+                del self._queues[session_id]
+                if queue:
+                    self._queues[session_id] = queue
+                self._backlog -= 1
+                self._requests.consume(1)
+                self._tokens.consume(cost_tokens)
+
+            try:
+                self._executor.submit(self._run, key, fn, future)
+            except RuntimeError as e:
+                # The interpreter is shutting down and the executor no longer accepts work
+                future.set_exception(e)
+                return
+
+    def _run(self, key, fn, future):
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn())
+                except BaseException as e:
+                    future.set_exception(e)
+        finally:
+            if key is not None:
+                with self._cond:
+                    self._inflight.pop(key, None)
+
+@st.cache_resource
+def get_dispatcher():
+    return GeminiDispatcher(
+        requests_per_minute=int(get_setting("requests_per_minute", 0, section="dispatcher")),
+        tokens_per_minute=int(get_setting("tokens_per_minute", 0, section="dispatcher")),
+        max_backlog=int(get_setting("max_backlog", 100, section="dispatcher")),
+        workers=int(get_setting("workers", 8, section="dispatcher")),
+    )
+
+# Admission control: refuse new games while the shared queue is already deep
+def accepting_new_games():
+    dispatcher = get_dispatcher()
+    limit = int(get_setting("admission_depth", dispatcher.max_backlog // 2, section="dispatcher"))
+    return dispatcher.queue_depth() < limit
+
+# Model used when no route is configured for a prompt type
+DEFAULT_MODEL = "gemini-1.5-flash"
+
+# Models per prompt type, in order of preference; later entries are failover alternates
+MODEL_ROUTES = {
+    "opening": ["gemini-1.5-flash", "gemini-1.5-flash-8b"],
+    "scene": ["gemini-1.5-flash", "gemini-1.5-flash-8b"],
+    "choices": ["gemini-1.5-flash-8b", "gemini-1.5-flash"],
+    "conclusion": ["gemini-1.5-flash", "gemini-1.5-flash-8b"],
+    "default": [DEFAULT_MODEL],
+}
+
+# Picks a model per prompt type from rolling latency and error windows
+class ModelRouter:
+    def __init__(self, routes, window=50, window_seconds=300.0, min_samples=10,
+                 max_p95_seconds=15.0, max_error_rate=0.25):
+        self.routes = routes
+        self.window = window
+        self.window_seconds = window_seconds
+        self.min_samples = min_samples
+        self.max_p95_seconds = max_p95_seconds
+        self.max_error_rate = max_error_rate
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def record(self, prompt_type, model, seconds, ok):
+        with self._lock:
+            window = self._windows.setdefault((prompt_type, model), deque(maxlen=self.window))
+            window.append((time.monotonic(), seconds, ok))
+
+    # Samples older than window_seconds are ignored so a demoted model gets retried later
+    def _samples(self, prompt_type, model):
+        cutoff = time.monotonic() - self.window_seconds
+        with self._lock:
+            return [(seconds, ok) for at, seconds, ok in self._windows.get((prompt_type, model), ()) if at >= cutoff]
+
+    def latency_percentile(self, prompt_type, model, q):
+        latencies = sorted(seconds for seconds, ok in self._samples(prompt_type, model) if ok)
+        if len(latencies) < self.min_samples:
+            return None
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+    def healthy(self, prompt_type, model):
+        samples = self._samples(prompt_type, model)
+        if len(samples) < self.min_samples:
+            return True
+        error_rate = sum(1 for _, ok in samples if not ok) / len(samples)
+        p95 = self.latency_percentile(prompt_type, model, 0.95)
+        return error_rate <= self.max_error_rate and (p95 is None or p95 <= self.max_p95_seconds)
+
+    def choose(self, prompt_type):
+        models = self.routes.get(prompt_type) or self.routes.get("default") or [DEFAULT_MODEL]
+        for model in models:
+            if self.healthy(prompt_type, model):
+                return model
+        return models[0]
+
+@st.cache_resource
+def get_model_router():
+    routes = dict(MODEL_ROUTES)
+    try:
+        routes.update({key: list(value) for key, value in st.secrets["routes"].items()})
+    except Exception:
+        pass
+    return ModelRouter(
+        routes,
+        window=int(get_setting("window", 50, section="routing")),
+        window_seconds=float(get_setting("window_seconds", 300.0, section="routing")),
+        min_samples=int(get_setting("min_samples", 10, section="routing")),
+        max_p95_seconds=float(get_setting("max_p95_seconds", 15.0, section="routing")),
+        max_error_rate=float(get_setting("max_error_rate", 0.25, section="routing")),
+    )
+
+# A hedged call can hold two workers (primary and duplicate), so the default is twice the dispatcher's pool
+@st.cache_resource
+def get_hedge_executor():
+    default_workers = 2 * int(get_setting("workers", 8, section="dispatcher"))
+    return ThreadPoolExecutor(max_workers=int(get_setting("workers", default_workers, section="hedging")),
+                              thread_name_prefix="gemini-hedge")
+
+# Call the API and feed the outcome into the router's rolling window
+def timed_generate(client, router, metrics, metrics_logger, prompt_type, model, payload):
+    started = time.monotonic()
+    info = {}
+    try:
+        result = client.generate_content(model, payload, info=info)
+    except Exception:
+        seconds = time.monotonic() - started
+        router.record(prompt_type, model, seconds, False)
+        record_llm_call(metrics, metrics_logger, prompt_type, model, seconds, info)
+        raise
+    seconds = time.monotonic() - started
+    router.record(prompt_type, model, seconds, True)
+    record_llm_call(metrics, metrics_logger, prompt_type, model, seconds, info, result.get("usageMetadata"))
+    return result
+
+# Send a duplicate request if the first is slower than hedge_delay and take whichever finishes first
+def hedged_generate(client, router, metrics, metrics_logger, dispatcher, executor, prompt_type, model,
+                    payload, hedge_delay, cost_tokens):
+    running = threading.Event()
+    def run_primary():
+        running.set()
+        return timed_generate(client, router, metrics, metrics_logger, prompt_type, model, payload)
+    primary = executor.submit(run_primary)
+    # The hedge delay counts from when the primary is actually sent, not from time spent queued for a worker
+    running.wait()
+    done, _ = wait([primary], timeout=hedge_delay)
+    # Hedges only use spare rate-limit budget so they never delay other sessions
+    if done or not dispatcher.try_acquire(cost_tokens):
+        return primary.result()
+
+    metrics.inc("story_llm_hedges_total", {"prompt_type": prompt_type or "other", "model": model},
+                help_text="Duplicate requests sent by hedging")
+    pending = {primary, executor.submit(timed_generate, client, router, metrics, metrics_logger, prompt_type, model, payload)}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+    return primary.result()
+
+# Build the request payload for a prompt
+def build_payload(prompt, generation_config=None):
+    # Modify prompt to request Bengali language
+    bengali_prompt = f"Please respond in Bengali (Bangla) language only: {prompt}"
+    
+    payload = {
+        "contents": [{
+            "parts": [{"text": bengali_prompt}]
+        }]
     }
-    return lotties
+    if generation_config:
+        payload["generationConfig"] = generation_config
+    return payload
 
 # Function to generate story using Gemini API
-def generate_story(prompt, model="gemini-1.5-flash"):
+def generate_story(prompt, model=None, generation_config=None, stream=False, prompt_type=None):
+    # Streaming mode returns a generator of text chunks instead of the full text
+    if stream:
+        return generate_story_stream(prompt, model, generation_config, prompt_type)
+
     try:
-        # Get API key from Streamlit secrets
-        api_key = st.secrets["gemini"]["api_key"]
+        # Pick the model from the routing table unless the caller asked for one
+        router = get_model_router()
+        model = model or router.choose(prompt_type)
         
-        # Set up the API endpoint
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent?key={api_key}"
+        # Serve repeated prompts from the cache when this prompt type opts in
+        cache = cache_for(prompt_type)
+        cache_key = LLMCache.make_key(model, prompt, generation_config)
+        if cache is not None:
+            cached = cache.get(cache_key)
+            if cached is not None:
+                return cached
         
-        # Modify prompt to request Bengali language
-        bengali_prompt = f"Please respond in Bengali (Bangla) language only: {prompt}"
+        # Get the shared client (API key is read from Streamlit secrets)
+        client = get_gemini_client()
+        dispatcher = get_dispatcher()
+        metrics = get_metrics()
+        metrics_logger = get_metrics_logger()
         
         # Prepare the request payload
-        payload = {
-            "contents": [{
-                "parts": [{"text": bengali_prompt}]
-            }]
-        }
+        payload = build_payload(prompt, generation_config)
         
-        # Set headers
-        headers = {
-            "Content-Type": "application/json"
-        }
-        
-        # Make the API request
-        response = requests.post(url, headers=headers, json=payload)
-        
-        # Check if request was successful
-        if response.status_code != 200:
-            raise Exception(f"API request failed with status code: {response.status_code}, response: {response.text}")
-        
-        # Parse the response
-        result = response.json()
+        # Make the API request through the shared dispatcher (retries and timeouts are handled by the client)
+        estimated_tokens = estimate_tokens(payload["contents"][0]["parts"][0]["text"])
+        hedge_delay = None
+        if get_setting("enabled", False, section="hedging"):
+            # Hedge after the route's recent latency percentile, but never sooner than min_delay
+            observed = router.latency_percentile(prompt_type, model, float(get_setting("percentile", 0.95, section="hedging")))
+            if observed is not None:
+                hedge_delay = max(observed, float(get_setting("min_delay", 1.0, section="hedging")))
+        if hedge_delay is not None:
+            executor = get_hedge_executor()
+            call = lambda: hedged_generate(client, router, metrics, metrics_logger, dispatcher, executor,
+                                           prompt_type, model, payload, hedge_delay, estimated_tokens)
+        else:
+            call = lambda: timed_generate(client, router, metrics, metrics_logger, prompt_type, model, payload)
+        # Reconcile inside the dispatched call so coalesced waiters charge the bucket only once
+        def dispatched():
+            response = call()
+            dispatcher.reconcile(estimated_tokens, response.get("usageMetadata", {}).get("totalTokenCount"))
+            return response
+        flight_key = None if prompt_type in UNSHARED_PROMPT_TYPES else cache_key
+        future = dispatcher.submit(flight_key, current_session_id(), dispatched, estimated_tokens)
+        result = future.result()
         
         # Extract the generated text
         if (result and "candidates" in result and len(result["candidates"]) > 0 and
                 "content" in result["candidates"][0] and "parts" in result["candidates"][0]["content"] and
                 len(result["candidates"][0]["content"]["parts"]) > 0):
-            return result["candidates"][0]["content"]["parts"][0]["text"]
+            text = result["candidates"][0]["content"]["parts"][0]["text"]
+            # Only successful responses reach the cache; error text is returned below
+            if cache is not None:
+                cache.put(cache_key, text)
+            return text
         else:
             raise Exception("Unexpected response structure from Gemini API")
             
     except Exception as e:
-        st.error(f"Error generating story: {str(e)}")
-        return f"Error generating story. Please check your API configuration. Error: {str(e)}"
+        if not in_background():
+            st.error(f"Error generating story: {str(e)}")
+        return f"{ERROR_PREFIX} Please check your API configuration. Error: {str(e)}"
+
+# Function to stream a story from the Gemini API, yielding text as it arrives
+def generate_story_stream(prompt, model=None, generation_config=None, prompt_type=None):
+    received = False
+    started = None
+    info = {}
+    usage = None
+    try:
+        router = get_model_router()
+        model = model or router.choose(prompt_type)
+        
+        cache = cache_for(prompt_type)
+        cache_key = LLMCache.make_key(model, prompt, generation_config)
+        if cache is not None:
+            cached = cache.get(cache_key)
+            if cached is not None:
+                yield cached
+                return
+        
+        client = get_gemini_client()
+        payload = build_payload(prompt, generation_config)
+        
+        # Streams are not coalesced, but still wait for their turn under the rate limits
+        get_dispatcher().acquire(current_session_id(), estimate_tokens(payload["contents"][0]["parts"][0]["text"]))
+        started = time.monotonic()
+        
+        chunks = []
+        first_event = True
+        for event in client.stream_generate_content(model, payload, info=info):
+            # Time to first byte for a stream is when the first event arrives, not the headers
+            if first_event:
+                info["ttfb"] = time.monotonic() - started
+                first_event = False
+            usage = event.get("usageMetadata", usage)
+            # The final event may carry only a finish reason and no content
+            for candidate in event.get("candidates", [])[:1]:
+                for part in candidate.get("content", {}).get("parts", []):
+                    if part.get("text"):
+                        received = True
+                        chunks.append(part["text"])
+                        yield part["text"]
+        
+        if not received:
+            raise Exception("Unexpected response structure from Gemini API")
+        router.record(prompt_type, model, time.monotonic() - started, True)
+        record_llm_call(get_metrics(), get_metrics_logger(), prompt_type, model, time.monotonic() - started,
+                        info, usage, stream=True)
+        if cache is not None:
+            cache.put(cache_key, "".join(chunks))
+            
+    except Exception as e:
+        if started is not None:
+            router.record(prompt_type, model, time.monotonic() - started, False)
+            record_llm_call(get_metrics(), get_metrics_logger(), prompt_type, model, time.monotonic() - started,
+                            info, usage, stream=True)
+        if not in_background():
+            st.error(f"Error generating story: {str(e)}")
+        # A stream that already produced text keeps it; otherwise report the failure
+        if not received:
+            yield f"{ERROR_PREFIX} Please check your API configuration. Error: {str(e)}"
+
+# Bounded story memory: a rolling summary plus a short verbatim window of recent scenes.
+# It is a plain dict so it can live in st.session_state and be persisted with the game.
+def new_story_memory():
+    return {"summary": "", "recent": [], "pending": []}
+
+# Record a new scene; scenes pushed out of the window wait in "pending" until summarised
+def update_story_memory(memory, scene, chosen_choice=None):
+    entry = f"The protagonist chose: {chosen_choice}\n{scene}" if chosen_choice else scene
+    memory["recent"].append(entry)
+    window = int(get_setting("recent_scenes", 2, section="memory"))
+    while len(memory["recent"]) > window:
+        memory["pending"].append(memory["recent"].pop(0))
+    # If summarising keeps failing, drop the oldest unsummarised scenes rather than grow the prompt
+    del memory["pending"][:-max(window, 1) * 2]
+
+# Context for prompts; the newest scene is left out because prompts quote it as the current situation
+def memory_context(memory):
+    if not memory:
+        return ""
+    parts = []
+    if memory["summary"]:
+        parts.append(f"Summary: {memory['summary']}")
+    earlier = memory["pending"] + memory["recent"][:-1]
+    if earlier:
+        parts.append("Recent scenes:\n" + "\n\n".join(earlier))
+    return "\n\n".join(parts)
+
+def story_context(context):
+    return f"\n    Story so far:\n    {context}\n" if context else ""
+
+# Function to fold scenes into the running summary without re-reading the whole story
+def summarise_events(summary, events, genre):
+    words = int(get_setting("summary_words", 120, section="memory"))
+    prompt = f"""
+    This is the running summary of a {genre} story:
+    
+    {summary or "(the story has just begun)"}
+    
+    These events happened next:
+    
+    {chr(10).join(events)}
+    
+    Rewrite the summary so it also covers these events, in at most {words} words.
+    Keep names, goals, important objects and unresolved threads. Only return the summary.
+    Write this in Bengali (Bangla) language only.
+    """
+    result = generate_story(prompt, prompt_type="summary")
+    if is_error_text(result):
+        raise GeminiError(result)
+    return result.strip()
+
+# Default choices used whenever the model's choices cannot be parsed
+FALLBACK_CHOICES = {
+    "choice1": "সাবধানে অগ্রসর হন এবং আরও অনুসন্ধান করুন",  # Continue cautiously and investigate further in Bengali
+    "choice2": "একটি সাহসী পদ্ধতি নিন এবং পরিস্থিতির মুখোমুখি হন"  # Take a bold approach and face the situation head-on in Bengali
+}
 
 # Function to generate story choices
-def generate_choices(current_scene, genre):
+def generate_choices(current_scene, genre, context=""):
     prompt = f"""
     Given the following scene in a {genre} story:
-    
+    {story_context(context)}
     {current_scene}
     
     Generate two relative distinct and very interesting choices for the protagonist. Each choice should lead the story in a different direction.
@@ -154,7 +1202,7 @@ def generate_choices(current_scene, genre):
     """
     
     try:
-        result = generate_story(prompt)
+        result = generate_story(prompt, prompt_type="choices")
         # Extract JSON from the response
         json_str = result.strip()
         if not json_str.startswith('{'):
@@ -171,18 +1219,21 @@ def generate_choices(current_scene, genre):
         choices = json.loads(json_str)
         return choices
     except Exception as e:
-        st.warning(f"Error generating choices: {str(e)}. Using fallback choices.")
+        if not in_background():
+            st.warning(f"Error generating choices: {str(e)}. Using fallback choices.")
         # Fallback to default choices if there's an error
-        return {
-            "choice1": "সাবধানে অগ্রসর হন এবং আরও অনুসন্ধান করুন",  # Continue cautiously and investigate further in Bengali
-            "choice2": "একটি সাহসী পদ্ধতি নিন এবং পরিস্থিতির মুখোমুখি হন"  # Take a bold approach and face the situation head-on in Bengali
-        }
+        return dict(FALLBACK_CHOICES)
 
 # Function to generate next scene based on choice
-def generate_next_scene(current_scene, chosen_choice, genre):
-    prompt = f"""
+def generate_next_scene(current_scene, chosen_choice, genre, context=""):
+    result = generate_story(next_scene_prompt(current_scene, chosen_choice, genre, context), prompt_type="scene")
+    return clean_next_scene(result, current_scene)
+
+# Prompt for continuing the story after a choice
+def next_scene_prompt(current_scene, chosen_choice, genre, context=""):
+    return f"""
     In this {genre} story:
-    
+    {story_context(context)}
     Current situation: {current_scene}
     
     The protagonist decides to: {chosen_choice}
@@ -190,9 +1241,8 @@ def generate_next_scene(current_scene, chosen_choice, genre):
     Continue the story with an engaging scene (100-150 words) based on this choice. Make it relatively vivid and immersive.
     Write this in Bengali (Bangla) language only.
     """
-    
-    result = generate_story(prompt)
-    
+
+def clean_next_scene(result, current_scene):
     # Clean up the result to get just the new scene
     if current_scene in result:
         result = result.split(current_scene)[1]
@@ -202,34 +1252,904 @@ def generate_next_scene(current_scene, chosen_choice, genre):
     
     return result
 
-# Function to create a downloadable story
-def get_download_link(story_text, filename="my_adventure.txt"):
-    """Generates a link to download the story text as a file"""
-    b64 = base64.b64encode(story_text.encode()).decode()
-    href = f'<a href="data:file/txt;base64,{b64}" download="{filename}">Download your adventure story</a>'
-    return href
+# Response schema for generating a scene and its choices in a single request
+TURN_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "scene": {"type": "STRING"},
+        "choice1": {"type": "STRING"},
+        "choice2": {"type": "STRING"},
+    },
+    "required": ["scene", "choice1", "choice2"],
+    "propertyOrdering": ["scene", "choice1", "choice2"],
+}
+
+# Validate a structured turn response and return (scene, choices)
+def parse_turn_response(text, current_scene=""):
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Turn response is not valid JSON: {str(e)}")
+    if not isinstance(data, dict):
+        raise ValueError("Turn response is not a JSON object")
+
+    for field in TURN_SCHEMA["required"]:
+        value = data.get(field)
+        if not isinstance(value, str) or not value.strip():
+            raise ValueError(f"Turn response is missing '{field}'")
+
+    scene = data["scene"]
+    if current_scene and current_scene in scene:
+        scene = scene.split(current_scene)[1]
+    choices = {"choice1": data["choice1"].strip(), "choice2": data["choice2"].strip()}
+    return scene.strip(), choices
+
+# Function to generate the next scene and its choices together in one request
+def generate_turn(current_scene, chosen_choice, genre, context=""):
+    prompt = f"""
+    In this {genre} story:
+    {story_context(context)}
+    Current situation: {current_scene}
+    
+    The protagonist decides to: {chosen_choice}
+    
+    Continue the story with an engaging scene (100-150 words) based on this choice. Make it relatively vivid and immersive.
+    Then give two relative distinct and very interesting choices (10-15 words each) for what the protagonist does next.
+    Each choice should lead the story in a different direction.
+    Return a JSON object with the fields "scene", "choice1" and "choice2".
+    Write everything in Bengali (Bangla) language only.
+    """
+    
+    generation_config = {
+        "responseMimeType": "application/json",
+        "responseSchema": TURN_SCHEMA,
+    }
+    result = generate_story(prompt, generation_config=generation_config, prompt_type="scene")
+    if is_error_text(result):
+        raise GeminiError(result)
+    
+    scene, choices = parse_turn_response(result, current_scene)
+    return {"scene": scene, "choices": choices}
+
+# Bounded thread pool for speculative work; submissions are dropped when it is saturated
+class BackgroundPool:
+    def __init__(self, max_workers, max_pending):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="story-bg")
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    @staticmethod
+    def _run(fn, args, session_id):
+        _worker_state.background = True
+        _worker_state.session_id = session_id
+        try:
+            return fn(*args)
+        finally:
+            _worker_state.background = False
+            _worker_state.session_id = None
+
+    def submit(self, fn, *args, session_id=None):
+        if not self._slots.acquire(blocking=False):
+            return None
+        future = self.executor.submit(self._run, fn, args, session_id or current_session_id())
+        future.add_done_callback(lambda f: self._slots.release())
+        return future
+
+@st.cache_resource
+def get_prefetch_pool():
+    return BackgroundPool(
+        max_workers=int(get_setting("workers", 4, section="prefetch")),
+        max_pending=int(get_setting("max_pending", 16, section="prefetch")),
+    )
+
+# Function to generate a complete branch: the next scene plus its follow-up choices
+def generate_branch(current_scene, chosen_choice, genre, final_turn=False, context=""):
+    # Combined mode asks for the scene and choices in one structured request
+    if not final_turn and get_setting("turn_mode", "combined") == "combined":
+        try:
+            return generate_turn(current_scene, chosen_choice, genre, context)
+        except GeminiError as e:
+            return {"scene": str(e), "choices": dict(FALLBACK_CHOICES)}
+        except ValueError:
+            # Malformed structured output: fall back to the two-call path below
+            pass
+
+    next_scene = generate_next_scene(current_scene, chosen_choice, genre, context)
+    choices = {} if final_turn else generate_choices(next_scene, genre, context)
+    return {"scene": next_scene, "choices": choices}
+
+# Background variant that refuses to store failed generations
+def generate_prefetch_branch(current_scene, chosen_choice, genre, final_turn=False, context=""):
+    branch = generate_branch(current_scene, chosen_choice, genre, final_turn, context)
+    if is_error_text(branch["scene"]):
+        raise GeminiError(branch["scene"])
+    return branch
+
+# Start generating both candidate branches while the player is still reading
+def start_prefetch():
+    if not get_setting("enabled", True, section="prefetch"):
+        return
+    # Branches that continue inside the precompiled tree are already on disk
+    static_children = {key: static_child(key) for key in ("choice1", "choice2")}
+    if all(child is not None for child in static_children.values()):
+        return
+    prefetch = st.session_state.get("prefetch")
+    if prefetch and prefetch["decision"] == st.session_state.choice_count:
+        return
+
+    pool = get_prefetch_pool()
+    final_turn = st.session_state.choice_count + 1 >= MAX_DECISIONS
+    context = memory_context(st.session_state.memory)
+    futures = {}
+    for choice_key in ("choice1", "choice2"):
+        chosen_choice = st.session_state.choices.get(choice_key)
+        if not chosen_choice or static_children[choice_key] is not None:
+            continue
+        future = pool.submit(generate_prefetch_branch, st.session_state.current_scene, chosen_choice,
+                             st.session_state.genre, final_turn, context)
+        if future is not None:
+            futures[choice_key] = future
+
+    st.session_state.prefetch = {"decision": st.session_state.choice_count, "futures": futures}
+
+# Claim the prefetched branch future for a choice and discard the other one
+def take_prefetched_branch(choice_key):
+    prefetch = st.session_state.get("prefetch")
+    st.session_state.prefetch = None
+    if not prefetch or prefetch["decision"] != st.session_state.choice_count:
+        return None
+
+    for key, future in prefetch["futures"].items():
+        if key != choice_key:
+            future.cancel()
+
+    future = prefetch["futures"].get(choice_key)
+    # A branch that never left the queue is not worth waiting for
+    if future is None or future.cancel():
+        return None
+    return future
+
+# Prompt for the opening scene of a new story
+def opening_prompt(genre, player_name):
+    return f"""
+    Create an engaging opening scene for a {genre} story where the protagonist is named {player_name}.
+    Set the scene (about 100 words) with an interesting situation that will lead to choices.
+    Make it immersive and end at a point where the protagonist needs to make a decision.
+    Write this in Bengali (Bangla) language only.
+    """
+
+# Token that stands in for the player's name in pre-generated openings
+NAME_PLACEHOLDER = "[[NAME]]"
+
+# Function to generate an opening that uses the name placeholder; None when generation fails
+def generate_placeholder_opening(genre):
+    prompt = opening_prompt(genre, NAME_PLACEHOLDER) + f"""
+    Use the exact token {NAME_PLACEHOLDER} wherever the protagonist's name appears and do not translate it.
+    """
+    # Not the "opening" prompt type: cached answers would make every pre-generated opening identical
+    scene = generate_story(prompt, prompt_type="opening_pool")
+    if is_error_text(scene) or NAME_PLACEHOLDER not in scene:
+        return None
+    return scene, generate_choices(scene, genre)
+
+# Continue a pre-generated scene for the precompiled tree, keeping the name placeholder
+def generate_placeholder_scene(current_scene, chosen_choice, genre):
+    prompt = next_scene_prompt(current_scene, chosen_choice, genre) + f"""
+    Use the exact token {NAME_PLACEHOLDER} wherever the protagonist's name appears and do not translate it.
+    """
+    scene = clean_next_scene(generate_story(prompt, prompt_type="scene"), current_scene)
+    if is_error_text(scene) or NAME_PLACEHOLDER not in scene:
+        return None
+    return scene
+
+# Put the player's name into a pre-generated scene and its choices
+def fill_name(scene, choices, player_name):
+    scene = scene.replace(NAME_PLACEHOLDER, player_name)
+    choices = {key: str(value).replace(NAME_PLACEHOLDER, player_name) for key, value in choices.items()}
+    return scene, choices
+
+# Keeps a few ready (opening scene, choices) pairs per genre and refills them in the background
+class OpeningPool:
+    def __init__(self, genres, size, workers):
+        self.size = size
+        self._ready = {genre: deque() for genre in genres}
+        self._filling = {genre: 0 for genre in genres}
+        self._lock = threading.Lock()
+        self._pool = BackgroundPool(max_workers=workers, max_pending=size * len(genres))
+        for genre in genres:
+            self.refill(genre)
+
+    def refill(self, genre):
+        with self._lock:
+            missing = self.size - len(self._ready[genre]) - self._filling[genre]
+            for _ in range(max(missing, 0)):
+                if self._pool.submit(self._fill_one, genre, session_id="warm-pool") is None:
+                    break
+                self._filling[genre] += 1
+
+    def _fill_one(self, genre):
+        try:
+            opening = generate_placeholder_opening(genre)
+            if opening is None:
+                return
+            with self._lock:
+                self._ready[genre].append(opening)
+        finally:
+            with self._lock:
+                self._filling[genre] -= 1
+
+    def take(self, genre, player_name):
+        with self._lock:
+            entry = self._ready[genre].popleft() if self._ready.get(genre) else None
+        if genre in self._ready:
+            self.refill(genre)
+        if entry is None:
+            return None
+        return fill_name(entry[0], entry[1], player_name)
+
+@st.cache_resource
+def get_opening_pool():
+    return OpeningPool(
+        genres=list(GENRE_OPTIONS.keys()),
+        size=int(get_setting("size", 2, section="warm_pool")),
+        workers=int(get_setting("workers", 2, section="warm_pool")),
+    )
+
+# Precompiled story trees (see precompile.py): a header, a fixed-size node table and a UTF-8
+# text blob that node records point into, so a tree can be memory-mapped and read lazily.
+STORY_TREE_MAGIC = b"STRY"
+STORY_TREE_VERSION = 1
+STORY_TREE_HEADER = struct.Struct("<4sHII")
+# parent, child1, child2, then (offset, length) of the scene, choice1 and choice2 text
+STORY_TREE_NODE = struct.Struct("<iiiIIIIII")
+
+# Function to write a tree from a list of nodes ordered so that the root is first
+def write_story_tree(path, nodes):
+    index = {node["path"]: i for i, node in enumerate(nodes)}
+    table = bytearray()
+    blob = bytearray()
+
+    def add_text(text):
+        data = text.encode("utf-8")
+        blob.extend(data)
+        return len(blob) - len(data), len(data)
+
+    for node in nodes:
+        parent = index.get(node["path"][:-1], -1) if node["path"] else -1
+        children = [index.get(node["path"] + key, -1) for key in ("1", "2")]
+        scene = add_text(node["scene"])
+        choice1 = add_text(node["choices"].get("choice1", ""))
+        choice2 = add_text(node["choices"].get("choice2", ""))
+        table.extend(STORY_TREE_NODE.pack(parent, children[0], children[1], *scene, *choice1, *choice2))
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(STORY_TREE_HEADER.pack(STORY_TREE_MAGIC, STORY_TREE_VERSION, len(nodes), len(table)))
+        f.write(table)
+        f.write(blob)
+    os.replace(tmp_path, path)
+
+# Read-only view of a compiled tree; node text is decoded only when a node is visited
+class StoryTree:
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.node_count, table_size = STORY_TREE_HEADER.unpack_from(self._data, 0)
+        if magic != STORY_TREE_MAGIC or version != STORY_TREE_VERSION:
+            raise ValueError(f"{path} is not a version {STORY_TREE_VERSION} story tree")
+        self._table = STORY_TREE_HEADER.size
+        self._blob = self._table + table_size
+
+    def _text(self, offset, length):
+        start = self._blob + offset
+        return self._data[start:start + length].decode("utf-8")
+
+    def node(self, index):
+        record = STORY_TREE_NODE.unpack_from(self._data, self._table + index * STORY_TREE_NODE.size)
+        return {
+            "scene": self._text(record[3], record[4]),
+            "choices": {"choice1": self._text(record[5], record[6]), "choice2": self._text(record[7], record[8])},
+        }
+
+    # Index of the node reached by a choice, or None at the frontier of the tree
+    def child(self, index, choice_key):
+        record = STORY_TREE_NODE.unpack_from(self._data, self._table + index * STORY_TREE_NODE.size)
+        child = record[1] if choice_key == "choice1" else record[2]
+        return child if child >= 0 else None
+
+def story_tree_path(genre, directory=None):
+    return os.path.join(directory or app_path(get_setting("dir", "story_trees", section="static")), f"{genre}.stree")
+
+# Load a genre's compiled tree once per process; None when static mode is off or it was never built
+@st.cache_resource
+def _load_story_tree(path):
+    return StoryTree(path)
+
+def get_story_tree(genre):
+    if not get_setting("enabled", False, section="static"):
+        return None
+    path = story_tree_path(genre)
+    if not os.path.exists(path):
+        return None
+    try:
+        return _load_story_tree(path)
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring story tree %s: %s", path, e)
+        return None
+
+# Index of the precompiled node a choice leads to, or None when that choice leaves the tree
+def static_child(choice_key):
+    index = st.session_state.get("static_node")
+    tree = get_story_tree(st.session_state.genre) if index is not None else None
+    return tree.child(index, choice_key) if tree is not None else None
+
+# Follow a choice through the compiled tree; returns (scene, choices) or None at the frontier
+def take_static_branch(choice_key):
+    index = st.session_state.get("static_node")
+    tree = get_story_tree(st.session_state.genre) if index is not None else None
+    child = tree.child(index, choice_key) if tree is not None else None
+    if child is None:
+        # Past the end of the precompiled tree the story continues with live generation
+        st.session_state.static_node = None
+        return None
+    st.session_state.static_node = child
+    node = tree.node(child)
+    return fill_name(node["scene"], node["choices"], st.session_state.player_name)
+
+# Function to stream the next scene into a list of parts (read by the script thread) and return the finished text
+def stream_next_scene(current_scene, chosen_choice, genre, parts, context=""):
+    prompt = next_scene_prompt(current_scene, chosen_choice, genre, context)
+    for chunk in generate_story(prompt, stream=True, prompt_type="scene"):
+        parts.append(chunk)
+    return clean_next_scene("".join(parts), current_scene)
+
+# Summarise scenes that left the verbatim window, in the background when possible
+def fold_story_memory():
+    # Static mode makes no API calls while both choices stay in the tree; at its frontier the
+    # summary is folded ahead of the first live turn
+    if static_child("choice1") is not None and static_child("choice2") is not None:
+        return
+    memory = st.session_state.memory
+    fold = st.session_state.get("memory_fold")
+    if fold is not None:
+        events, future = fold
+        if not future.done():
+            return
+        st.session_state.memory_fold = None
+        try:
+            memory["summary"] = future.result()
+            # Remove exactly the summarised scenes; pending may have been trimmed meanwhile
+            for event in events:
+                if event in memory["pending"]:
+                    memory["pending"].remove(event)
+        except Exception:
+            # The same scenes are retried with the next fold
+            pass
+
+    if not memory["pending"]:
+        return
+    events = list(memory["pending"])
+    # When the pool is saturated the fold waits for the next render; pending stays bounded meanwhile
+    future = get_prefetch_pool().submit(summarise_events, memory["summary"], events, st.session_state.genre)
+    if future is not None:
+        st.session_state.memory_fold = (events, future)
+
+# Track the per-turn prompt size so the memory bound can be checked
+def record_prompt_size(current_scene, context):
+    tokens = estimate_tokens(current_scene + context)
+    st.session_state.prompt_tokens.append(tokens)
+    get_metrics().observe("story_turn_prompt_tokens", tokens, help_text="Estimated prompt context per turn (scene plus memory)",
+                          buckets=TOKEN_BUCKETS)
+    log_event("prompt_size", session_id=current_session_id(), decision=st.session_state.choice_count + 1, tokens=tokens)
+
+# Turn generation runs on its own pool, off the script thread. A second click while the
+# spinner shows makes Streamlit stop the current run, and the generation survives that
+@st.cache_resource
+def get_turn_pool():
+    return BackgroundPool(
+        max_workers=int(get_setting("workers", 8, section="turns")),
+        max_pending=int(get_setting("max_pending", 64, section="turns")),
+    )
+
+# Produce the next scene, choices and where they came from (prefetch, stream or live); runs on the turn pool
+def run_turn(prefetched, current_scene, chosen_choice, genre, final_turn, context, parts):
+    if prefetched is not None:
+        try:
+            branch = prefetched.result()
+            return branch["scene"], branch["choices"], "prefetch"
+        except Exception:
+            pass
+
+    # Streaming shows the scene as it is written; choices are requested once it is done
+    if parts is not None:
+        next_scene = stream_next_scene(current_scene, chosen_choice, genre, parts, context)
+        if final_turn:
+            return next_scene, {}, "stream"
+        return next_scene, generate_choices(next_scene, genre, context), "stream"
+
+    branch = generate_branch(current_scene, chosen_choice, genre, final_turn=final_turn, context=context)
+    return branch["scene"], branch["choices"], "live"
+
+# Start the turn for the decision point a choice was clicked on. The decision index is its
+# idempotency key: clicks made on an earlier decision are dropped, and while a turn is in
+# flight further clicks attach to it instead of starting another one
+def begin_turn(choice_key, decision):
+    if decision != st.session_state.choice_count:
+        return
+    turn = st.session_state.get("turn")
+    if turn is not None and turn["decision"] == decision:
+        return
+    # Callbacks run before the script body tags the thread with its session
+    _worker_state.session_id = st.session_state.session_id
+
+    chosen_choice = st.session_state.choices[choice_key]
+    context = memory_context(st.session_state.memory)
+    record_prompt_size(st.session_state.current_scene, context)
+    final_turn = st.session_state.choice_count + 1 >= MAX_DECISIONS
+    turn = {
+        "decision": st.session_state.choice_count,
+        "chosen_choice": chosen_choice,
+        "started": time.monotonic(),
+        "parts": [] if get_setting("stream", True) else None,
+    }
+
+    # Static mode walks the precompiled tree without any network calls
+    static_branch = take_static_branch(choice_key)
+    if static_branch is not None:
+        turn["future"] = Future()
+        turn["future"].set_result((static_branch[0], {} if final_turn else static_branch[1], "static"))
+    else:
+        args = (take_prefetched_branch(choice_key), st.session_state.current_scene, chosen_choice,
+                st.session_state.genre, final_turn, context, turn["parts"])
+        turn["future"] = get_turn_pool().submit(run_turn, *args, session_id=st.session_state.session_id)
+        if turn["future"] is None:
+            # The pool is saturated; generate on the script thread instead
+            turn["future"] = Future()
+            turn["future"].set_result(run_turn(*args))
+
+    st.session_state.turn = turn
+
+# Wait for the in-flight turn, showing streamed text as it arrives, then apply it exactly once
+# (the decision index moves on when it is applied, so a stale turn can never apply twice)
+def finish_turn(turn, scene_placeholder):
+    if turn["decision"] != st.session_state.choice_count:
+        # Left over from before a reset or resume
+        st.session_state.turn = None
+        return
+
+    future = turn["future"]
+    with st.spinner("আপনার অ্যাডভেঞ্চার চালিয়ে যাওয়া হচ্ছে..."):  # Continuing your adventure in Bengali
+        shown = 0
+        while not future.done():
+            parts = turn["parts"]
+            if parts and len(parts) != shown:
+                shown = len(parts)
+                scene_placeholder.markdown("".join(parts))
+            time.sleep(0.05)
+
+    st.session_state.turn = None
+    next_scene, new_choices, source = future.result()
+
+    # Update game state
+    st.session_state.story_log.append(("player", turn["chosen_choice"]))
+    st.session_state.current_scene = next_scene
+    st.session_state.story_log.append(("narrator", next_scene))
+    update_story_memory(st.session_state.memory, next_scene, turn["chosen_choice"])
+    st.session_state.choice_count += 1
+
+    # Check if game should end
+    if st.session_state.choice_count >= MAX_DECISIONS:
+        st.session_state.game_over = True
+    else:
+        st.session_state.choices = new_choices
+
+    persist_game()
+    record_turn(time.monotonic() - turn["started"], source, turn["decision"])
+
+# Per-turn end-to-end time, labelled with where the next scene came from
+def record_turn(seconds, source, decision):
+    get_metrics().observe("story_turn_seconds", seconds, {"source": source},
+                          help_text="Time from a choice click to the saved next turn")
+    log_event("turn", source=source, seconds=round(seconds, 4), session_id=current_session_id(),
+              decision=decision)
+
+# Version of the persisted game format; bump it when the layout below changes
+SESSION_FORMAT_VERSION = 1
+
+# Game state is stored as a small JSON snapshot plus an append-only log of story entries
+def encode_state(state):
+    return json.dumps({"v": SESSION_FORMAT_VERSION, **state}, separators=(",", ":"), ensure_ascii=False)
+
+def decode_state(raw):
+    state = json.loads(raw)
+    version = state.pop("v", None)
+    if version != SESSION_FORMAT_VERSION:
+        raise ValueError(f"Unsupported saved game version: {version}")
+    return state
+
+def encode_entry(role, text):
+    return json.dumps(["p" if role == "player" else "n", text], separators=(",", ":"), ensure_ascii=False)
+
+def decode_entry(raw):
+    kind, text = json.loads(raw)
+    return ("player" if kind == "p" else "narrator", text)
+
+# Raised when a save was made from a stale copy of the game, e.g. the same code resumed in two tabs
+class StaleSaveError(Exception):
+    pass
+
+# SQLite backend: one row per game for the snapshot and one row per log entry
+class SQLiteSessionStore:
+    def __init__(self, path, ttl_seconds=7 * 86400):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS games (token TEXT PRIMARY KEY, state TEXT NOT NULL, updated REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS games_updated ON games (updated)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS game_log "
+            "(token TEXT NOT NULL, seq INTEGER NOT NULL, entry TEXT NOT NULL, PRIMARY KEY (token, seq))"
+        )
+        self._db.commit()
+
+    # `expected` is how many log entries this session believes are already saved
+    def append(self, token, entries, state, expected):
+        with self._lock, self._db:
+            row = self._db.execute("SELECT COUNT(*) FROM game_log WHERE token = ?", (token,)).fetchone()
+            if row[0] != expected:
+                raise StaleSaveError(f"Game {token} has {row[0]} saved entries, expected {expected}")
+            self._db.executemany(
+                "INSERT INTO game_log (token, seq, entry) VALUES (?, ?, ?)",
+                [(token, expected + i, entry) for i, entry in enumerate(entries)]
+            )
+            self._db.execute("INSERT OR REPLACE INTO games (token, state, updated) VALUES (?, ?, ?)", (token, state, time.time()))
+            self._writes += 1
+            # Expire games not saved within the TTL, like the Redis backend; pruning is amortised over writes
+            if self._writes % 50 == 0:
+                self._prune()
+
+    def _prune(self):
+        cutoff = time.time() - self.ttl_seconds
+        self._db.execute("DELETE FROM game_log WHERE token IN (SELECT token FROM games WHERE updated < ?)", (cutoff,))
+        self._db.execute("DELETE FROM games WHERE updated < ?", (cutoff,))
+
+    def load(self, token):
+        with self._lock:
+            row = self._db.execute("SELECT state FROM games WHERE token = ? AND updated >= ?",
+                                   (token, time.time() - self.ttl_seconds)).fetchone()
+            if row is None:
+                return None
+            entries = [r[0] for r in self._db.execute("SELECT entry FROM game_log WHERE token = ? ORDER BY seq", (token,))]
+        return row[0], entries
+
+# Redis backend: a string key for the snapshot and a list key for the log
+class RedisSessionStore:
+    def __init__(self, client, ttl_seconds=7 * 86400):
+        self.client = client
+        self.ttl_seconds = ttl_seconds
+
+    def append(self, token, entries, state, expected):
+        log_key, state_key = f"story:{token}:log", f"story:{token}:state"
+        saved = self.client.llen(log_key)
+        if saved != expected:
+            raise StaleSaveError(f"Game {token} has {saved} saved entries, expected {expected}")
+        if entries:
+            self.client.rpush(log_key, *entries)
+        self.client.set(state_key, state)
+        self.client.expire(log_key, self.ttl_seconds)
+        self.client.expire(state_key, self.ttl_seconds)
+
+    def load(self, token):
+        state = self.client.get(f"story:{token}:state")
+        if state is None:
+            return None
+        entries = self.client.lrange(f"story:{token}:log", 0, -1)
+        decode = lambda value: value.decode("utf-8") if isinstance(value, bytes) else value
+        return decode(state), [decode(entry) for entry in entries]
+
+# In-process stand-in for the few Redis commands the store uses (redis_url = "memory://")
+class LocalRedis:
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def rpush(self, key, *values):
+        with self._lock:
+            self._data.setdefault(key, []).extend(values)
+            return len(self._data[key])
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+
+    def get(self, key):
+        with self._lock:
+            return self._data.get(key)
+
+    def llen(self, key):
+        with self._lock:
+            return len(self._data.get(key, []))
+
+    def lrange(self, key, start, end):
+        with self._lock:
+            values = self._data.get(key, [])
+            return list(values[start:] if end == -1 else values[start:end + 1])
+
+    def expire(self, key, seconds):
+        return key in self._data
+
+@st.cache_resource
+def get_session_store():
+    backend = get_setting("backend", "sqlite", section="session_store")
+    ttl_seconds = int(get_setting("ttl_seconds", 7 * 86400, section="session_store"))
+    if backend == "sqlite":
+        return SQLiteSessionStore(app_path(get_setting("path", ".cache/games.sqlite3", section="session_store")), ttl_seconds)
+    if backend == "redis":
+        url = get_setting("redis_url", "memory://", section="session_store")
+        if url == "memory://":
+            return RedisSessionStore(LocalRedis(), ttl_seconds)
+        import redis
+        return RedisSessionStore(redis.Redis.from_url(url), ttl_seconds)
+    return None
+
+# Save whatever the story log gained since the last save, plus the current snapshot
+def persist_game():
+    store = get_session_store()
+    if store is None:
+        return
+    if not st.session_state.get("game_token"):
+        st.session_state.game_token = uuid.uuid4().hex
+        st.session_state.persisted_entries = 0
+        st.query_params["game"] = st.session_state.game_token
+
+    new_entries = st.session_state.story_log[st.session_state.persisted_entries:]
+    state = {
+        "pn": st.session_state.player_name,
+        "ge": st.session_state.genre,
+        "c": st.session_state.choices,
+        "n": st.session_state.choice_count,
+        "g": st.session_state.game_over,
+        "e": "conclusion" in st.session_state,
+        "m": st.session_state.memory,
+        "s": st.session_state.static_node,
+    }
+    try:
+        store.append(st.session_state.game_token, [encode_entry(role, text) for role, text in new_entries],
+                     encode_state(state), st.session_state.persisted_entries)
+        st.session_state.persisted_entries = len(st.session_state.story_log)
+    except StaleSaveError as e:
+        # Another tab moved this game on; this copy stops saving instead of interleaving logs
+        logger.warning("Rejected stale save: %s", e)
+        st.session_state.save_conflict = True
+    except Exception as e:
+        # Losing a save must never interrupt the game itself
+        logger.warning("Could not save game %s: %s", st.session_state.game_token, e)
+
+# Restore a saved game into this session; returns False when the token is unknown
+def resume_game(token):
+    store = get_session_store()
+    if store is None:
+        return False
+    try:
+        saved = store.load(token)
+        if saved is None:
+            return False
+        state = decode_state(saved[0])
+        story_log = [decode_entry(entry) for entry in saved[1]]
+    except Exception as e:
+        logger.warning("Could not load game %s: %s", token, e)
+        return False
+
+    narration = [text for role, text in story_log if role == "narrator"]
+    if not narration:
+        return False
+    st.session_state.player_name = state["pn"]
+    st.session_state.genre = state["ge"]
+    st.session_state.choices = state["c"]
+    st.session_state.choice_count = state["n"]
+    st.session_state.game_over = state["g"]
+    st.session_state.memory = state["m"]
+    st.session_state.static_node = state.get("s")
+    st.session_state.story_log = story_log
+    if state["e"]:
+        st.session_state.conclusion = narration[-1]
+        narration = narration[:-1] or narration
+    st.session_state.current_scene = narration[-1]
+    st.session_state.game_token = token
+    st.session_state.persisted_entries = len(story_log)
+    st.session_state.save_conflict = False
+    st.session_state.start_game = True
+    st.query_params["game"] = token
+    return True
+
+# Export formats offered on the game-over screen: label, file extension and MIME type
+EXPORT_FORMATS = {
+    "markdown": ("Markdown", "md", "text/markdown"),
+    "html": ("HTML", "html", "text/html"),
+    "epub": ("EPUB", "epub", "application/epub+zip"),
+}
+
+# The story is produced piece by piece so long stories are never built with repeated +=
+def iter_story_markdown(title, player_name, story_log):
+    yield f"# {title}\n\n"
+    for role, text in story_log:
+        if role == "player":
+            yield f"\n**{player_name} chose:** {text}\n\n"
+        else:
+            yield f"{text}\n\n"
+
+def iter_story_html_body(title, player_name, story_log):
+    yield f"<h1>{html.escape(title)}</h1>\n"
+    for role, text in story_log:
+        if role == "player":
+            yield f'<p class="choice"><strong>{html.escape(player_name)} chose:</strong> {html.escape(text)}</p>\n'
+        else:
+            for paragraph in text.split("\n\n"):
+                if paragraph.strip():
+                    yield f"<p>{html.escape(paragraph.strip())}</p>\n"
+
+def iter_story_html(title, player_name, story_log):
+    yield (
+        '<!DOCTYPE html>\n<html lang="bn">\n<head>\n<meta charset="utf-8">\n'
+        f"<title>{html.escape(title)}</title>\n"
+        "<style>body{max-width:40em;margin:2em auto;line-height:1.6;font-family:'Tiro Bangla',serif}"
+        ".choice{color:#555}</style>\n</head>\n<body>\n"
+    )
+    yield from iter_story_html_body(title, player_name, story_log)
+    yield "</body>\n</html>\n"
+
+# Write chunks into a buffer as they are produced
+def write_chunks(stream, chunks):
+    for chunk in chunks:
+        stream.write(chunk.encode("utf-8"))
+
+# Function to package the story as a minimal EPUB 3 book
+def write_story_epub(buffer, story_id, title, player_name, story_log):
+    # Only EPUB downloads need zipfile, so it is not imported at startup
+    import zipfile
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as book:
+        # The mimetype entry must come first and be stored uncompressed
+        book.writestr("mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+        book.writestr("META-INF/container.xml", (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+            '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles>'
+            "</container>"
+        ))
+        book.writestr("OEBPS/content.opf", (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="bookid" xml:lang="bn">'
+            '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">'
+            f'<dc:identifier id="bookid">urn:story:{html.escape(story_id)}</dc:identifier>'
+            f"<dc:title>{html.escape(title)}</dc:title>"
+            f"<dc:creator>{html.escape(player_name)}</dc:creator>"
+            "<dc:language>bn</dc:language>"
+            f'<meta property="dcterms:modified">{time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}</meta>'
+            "</metadata>"
+            '<manifest><item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>'
+            '<item id="story" href="story.xhtml" media-type="application/xhtml+xml"/></manifest>'
+            '<spine><itemref idref="story"/></spine></package>'
+        ))
+        book.writestr("OEBPS/nav.xhtml", (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" xml:lang="bn">'
+            f"<head><title>{html.escape(title)}</title></head><body>"
+            f'<nav epub:type="toc"><ol><li><a href="story.xhtml">{html.escape(title)}</a></li></ol></nav>'
+            "</body></html>"
+        ))
+        with book.open("OEBPS/story.xhtml", "w") as chapter:
+            chapter.write((
+                '<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="bn">'
+                f"<head><title>{html.escape(title)}</title></head><body>\n"
+            ).encode("utf-8"))
+            write_chunks(chapter, iter_story_html_body(title, player_name, story_log))
+            chapter.write(b"</body></html>\n")
+
+# Build an export once per finished story and format; the story log is not hashed, the id is the key
+@st.cache_resource(max_entries=64, ttl=3600)
+def export_story(story_id, fmt, _title, _player_name, _story_log):
+    buffer = io.BytesIO()
+    if fmt == "markdown":
+        write_chunks(buffer, iter_story_markdown(_title, _player_name, _story_log))
+    elif fmt == "html":
+        write_chunks(buffer, iter_story_html(_title, _player_name, _story_log))
+    elif fmt == "epub":
+        write_story_epub(buffer, story_id, _title, _player_name, _story_log)
+    else:
+        raise ValueError(f"Unknown export format: {fmt}")
+    return buffer.getvalue()
 
 # Initialize session state variables
-if "start_game" not in st.session_state:
-    st.session_state.start_game = False
-if "player_name" not in st.session_state:
-    st.session_state.player_name = ""
-if "genre" not in st.session_state:
-    st.session_state.genre = ""
-if "current_scene" not in st.session_state:
-    st.session_state.current_scene = ""
-if "story_log" not in st.session_state:
-    st.session_state.story_log = []
-if "choices" not in st.session_state:
-    st.session_state.choices = {}
-if "choice_count" not in st.session_state:
-    st.session_state.choice_count = 0
-if "game_over" not in st.session_state:
-    st.session_state.game_over = False
+def init_session_state():
+    if "start_game" not in st.session_state:
+        st.session_state.start_game = False
+    if "player_name" not in st.session_state:
+        st.session_state.player_name = ""
+    if "genre" not in st.session_state:
+        st.session_state.genre = ""
+    if "current_scene" not in st.session_state:
+        st.session_state.current_scene = ""
+    if "story_log" not in st.session_state:
+        st.session_state.story_log = []
+    if "choices" not in st.session_state:
+        st.session_state.choices = {}
+    if "choice_count" not in st.session_state:
+        st.session_state.choice_count = 0
+    if "game_over" not in st.session_state:
+        st.session_state.game_over = False
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+    if "memory" not in st.session_state:
+        st.session_state.memory = new_story_memory()
+    if "prompt_tokens" not in st.session_state:
+        st.session_state.prompt_tokens = []
+    if "static_node" not in st.session_state:
+        st.session_state.static_node = None
+    if "turn" not in st.session_state:
+        st.session_state.turn = None
+
+# The story and choice panel reruns on its own when a choice is clicked, so a turn does not
+# re-send the page styles, sidebar or start screen
+@st.fragment
+def story_panel():
+    # Fragment reruns skip main(), so tag this thread with the session again
+    _worker_state.session_id = st.session_state.session_id
+    heading = st.container()
+    
+    # Display current scene
+    st.markdown('<div class="story-text">', unsafe_allow_html=True)
+    scene_placeholder = st.empty()
+    st.markdown('</div>', unsafe_allow_html=True)
+    
+    # A turn started by a choice click (or cut short by a second click) is finished first,
+    # streaming into the scene placeholder
+    turn = st.session_state.get("turn")
+    if turn is not None:
+        finish_turn(turn, scene_placeholder)
+        # The finished game needs the whole page; otherwise only this panel changes
+        if st.session_state.game_over:
+            st.rerun()
+    
+    with heading:
+        st.markdown(f"### {st.session_state.player_name}'s {st.session_state.genre.capitalize()} অ্যাডভেঞ্চার")  # Adventure in Bengali
+        
+        # Progress bar
+        progress = min(st.session_state.choice_count / MAX_DECISIONS, 1.0)
+        st.progress(progress)
+        st.markdown(f"সিদ্ধান্তের পয়েন্ট: {st.session_state.choice_count}/{MAX_DECISIONS}")  # Decision point in Bengali
+    scene_placeholder.write(st.session_state.current_scene)
+    
+    # Keep the story summary current, then generate both possible continuations
+    # in the background while the player reads
+    fold_story_memory()
+    start_prefetch()
+    
+    # Display choices; a click starts the turn in its callback, before this panel reruns
+    st.markdown("### আপনি কি করবেন?")  # What will you do? in Bengali
+    for column, choice_key, label in zip(st.columns(2), ("choice1", "choice2"), ("Option 1", "Option 2")):
+        with column:
+            st.button(st.session_state.choices.get(choice_key, label), key=f"btn_{choice_key}_{st.session_state.choice_count}",
+                      help="Select this path for your story", on_click=begin_turn,
+                      args=(choice_key, st.session_state.choice_count))
 
 # Main app logic
 def main():
-    lotties = get_lotties()
+    setup_page()
+    init_session_state()
+    
+    # Let generation calls made on this script thread know which session they serve
+    _worker_state.session_id = st.session_state.session_id
+    start_metrics_server()
+    
+    # Pick up a saved game from the URL, e.g. after a restart or on another replica
+    resume_token = st.query_params.get("game")
+    if resume_token and not st.session_state.start_game and not resume_game(resume_token):
+        del st.query_params["game"]
     
     # Title and introduction
     st.title("🔮 ইন্টারেক্টিভ গল্প অ্যাডভেঞ্চার")  # Interactive Story Adventure in Bengali
@@ -241,7 +2161,21 @@ def main():
         if st.button("গেম রিসেট করুন"):  # Reset Game in Bengali
             for key in list(st.session_state.keys()):
                 del st.session_state[key]
+            st.query_params.clear()
             st.rerun()
+        
+        # Resume code for the current game, or a field to continue a saved one
+        if st.session_state.get("game_token"):
+            st.markdown("আপনার গেম কোড:")  # Your game code in Bengali
+            st.code(st.session_state.game_token, language=None)
+            if st.session_state.get("save_conflict"):
+                st.warning("এই গেমটি অন্য একটি ট্যাবে এগিয়েছে; এখানকার অগ্রগতি সংরক্ষণ করা হচ্ছে না।")  # Game moved on in another tab; progress here is not saved in Bengali
+        elif not st.session_state.start_game:
+            resume_code = st.text_input("সংরক্ষিত গেম কোড")  # Saved game code in Bengali
+            if st.button("গেম চালিয়ে যান") and resume_code:  # Continue game in Bengali
+                if resume_game(resume_code.strip()):
+                    st.rerun()
+                st.error("এই কোডের কোনো গেম পাওয়া যায়নি।")  # No game found for this code in Bengali
             
         st.markdown("---")
         st.markdown("### কিভাবে খেলবেন")  # How to Play in Bengali
@@ -266,18 +2200,16 @@ def main():
             শুরু করতে, আপনার নাম লিখুন এবং আপনার অ্যাডভেঞ্চারের জন্য একটি ধরন নির্বাচন করুন।
             """)
             
+            # Start (or keep) filling the opening-scene warm pool in the background
+            # (static mode serves openings from disk and must not spend API quota on the pool)
+            warm_pool_enabled = get_setting("enabled", True, section="warm_pool") and not get_setting("enabled", False, section="static")
+            opening_pool = get_opening_pool() if warm_pool_enabled else None
+            
             # Player name input
             player_name = st.text_input("আপনার নাম", placeholder="আপনার নাম লিখুন")  # Your Name in Bengali
             
             # Genre selection
-            genre_options = {
-                "adventure": "অ্যাডভেঞ্চার 🏞️",  # Adventure in Bengali
-                "horror": "হরর 👻",  # Horror in Bengali
-                "romance": "রোমান্স ❤️",  # Romance in Bengali
-                "fantasy": "ফ্যান্টাসি 🧙‍♂️",  # Fantasy in Bengali
-                "mystery": "মিস্টেরি 🔍",  # Mystery in Bengali
-                "sci_fi": "সায়েন্স ফিকশন 🚀"  # Science Fiction in Bengali
-            }
+            genre_options = GENRE_OPTIONS
             
             selected_genre = st.selectbox("আপনার গল্পের ধরন বাছাই করুন", list(genre_options.values()))  # Choose your story genre in Bengali
             
@@ -285,114 +2217,61 @@ def main():
             selected_genre_key = list(genre_options.keys())[list(genre_options.values()).index(selected_genre)]
             
             # Start game button
-            if st.button("আপনার অ্যাডভেঞ্চার শুরু করুন") and player_name:  # Start Your Adventure in Bengali
+            start_clicked = st.button("আপনার অ্যাডভেঞ্চার শুরু করুন")  # Start Your Adventure in Bengali
+            if start_clicked and player_name and not accepting_new_games():
+                st.warning("সার্ভার এখন ব্যস্ত। অনুগ্রহ করে কিছুক্ষণ পরে আবার চেষ্টা করুন।")  # Server is busy, please try again shortly in Bengali
+            elif start_clicked and player_name:
                 st.session_state.player_name = player_name
                 st.session_state.genre = selected_genre_key
                 
-                # Generate initial scene
-                initial_prompt = f"""
-                Create an engaging opening scene for a {selected_genre_key} story where the protagonist is named {player_name}.
-                Set the scene (about 100 words) with an interesting situation that will lead to choices.
-                Make it immersive and end at a point where the protagonist needs to make a decision.
-                Write this in Bengali (Bangla) language only.
-                """
-                
                 try:
-                    with st.spinner("আপনার অ্যাডভেঞ্চার তৈরি করা হচ্ছে..."):  # Creating your adventure in Bengali
-                        initial_scene = generate_story(initial_prompt)
+                    # Serve the precompiled opening in static mode, else one from the warm pool
+                    opening = None
+                    story_tree = get_story_tree(selected_genre_key)
+                    if story_tree is not None and story_tree.node_count:
+                        root = story_tree.node(0)
+                        opening = fill_name(root["scene"], root["choices"], player_name)
+                        st.session_state.static_node = 0
+                    elif opening_pool:
+                        opening = opening_pool.take(selected_genre_key, player_name)
+                    if opening is not None:
+                        initial_scene, initial_choices = opening
                         st.session_state.current_scene = initial_scene
                         st.session_state.story_log.append(("narrator", initial_scene))
-                        
-                        # Generate initial choices
-                        initial_choices = generate_choices(initial_scene, selected_genre_key)
+                        update_story_memory(st.session_state.memory, initial_scene)
                         st.session_state.choices = initial_choices
+                    else:
+                        with st.spinner("আপনার অ্যাডভেঞ্চার তৈরি করা হচ্ছে..."):  # Creating your adventure in Bengali
+                            # Generate initial scene
+                            initial_scene = generate_story(opening_prompt(selected_genre_key, player_name), prompt_type="opening")
+                            st.session_state.current_scene = initial_scene
+                            st.session_state.story_log.append(("narrator", initial_scene))
+                            update_story_memory(st.session_state.memory, initial_scene)
+                            
+                            # Generate initial choices
+                            initial_choices = generate_choices(initial_scene, selected_genre_key)
+                            st.session_state.choices = initial_choices
                     
                     st.session_state.start_game = True
+                    persist_game()
                     st.rerun()
                 except Exception as e:
                     st.error(f"গেম শুরু করতে ত্রুটি: {str(e)}। অনুগ্রহ করে দেখুন Gemini API কী সঠিকভাবে সেট করা আছে কিনা।")  # Error message in Bengali
             
         with col2:
             # Display the Lottie animation for the selected genre
-            if selected_genre_key in lotties and lotties[selected_genre_key]:
-                st_lottie.st_lottie(lotties[selected_genre_key], key=f"lottie_{selected_genre_key}", height=300)
+            start_lottie_refresh()
+            animation = load_lottie(selected_genre_key, light=bool(get_setting("light", False, section="lottie")))
+            if animation:
+                # Imported here: only the start screen needs the component
+                import streamlit_lottie as st_lottie
+                st_lottie.st_lottie(animation, key=f"lottie_{selected_genre_key}", height=300)
             else:
-                st.image("https://via.placeholder.com/400x300?text=Interactive+Story+Adventure", use_container_width=True)
+                st.markdown(f'<img src="app/static/{PLACEHOLDER_IMAGE}" style="width: 100%" alt="Interactive Story Adventure">', unsafe_allow_html=True)
     
     # Game in progress
     elif st.session_state.start_game and not st.session_state.game_over:
-        # Display current scene
-        st.markdown(f"### {st.session_state.player_name}'s {st.session_state.genre.capitalize()} অ্যাডভেঞ্চার")  # Adventure in Bengali
-        
-        # Progress bar
-        progress = min(st.session_state.choice_count / 20, 1.0)
-        st.progress(progress)
-        st.markdown(f"সিদ্ধান্তের পয়েন্ট: {st.session_state.choice_count}/20")  # Decision point in Bengali
-        
-        # Display current scene
-        st.markdown('<div class="story-text">', unsafe_allow_html=True)
-        st.write(st.session_state.current_scene)
-        st.markdown('</div>', unsafe_allow_html=True)
-        
-        # Display choices
-        st.markdown("### আপনি কি করবেন?")  # What will you do? in Bengali
-        col1, col2 = st.columns(2)
-        
-        with col1:
-            if st.button(st.session_state.choices.get("choice1", "Option 1"), key="btn_choice1", help="Select this path for your story"):
-                chosen_choice = st.session_state.choices["choice1"]
-                st.session_state.story_log.append(("player", chosen_choice))
-                
-                with st.spinner("আপনার অ্যাডভেঞ্চার চালিয়ে যাওয়া হচ্ছে..."):  # Continuing your adventure in Bengali
-                    # Generate next scene
-                    next_scene = generate_next_scene(
-                        st.session_state.current_scene,
-                        chosen_choice,
-                        st.session_state.genre
-                    )
-                    
-                    # Update game state
-                    st.session_state.current_scene = next_scene
-                    st.session_state.story_log.append(("narrator", next_scene))
-                    st.session_state.choice_count += 1
-                    
-                    # Check if game should end
-                    if st.session_state.choice_count >= 20:
-                        st.session_state.game_over = True
-                    else:
-                        # Generate new choices
-                        new_choices = generate_choices(next_scene, st.session_state.genre)
-                        st.session_state.choices = new_choices
-                
-                st.rerun()
-                
-        with col2:
-            if st.button(st.session_state.choices.get("choice2", "Option 2"), key="btn_choice2", help="Select this path for your story"):
-                chosen_choice = st.session_state.choices["choice2"]
-                st.session_state.story_log.append(("player", chosen_choice))
-                
-                with st.spinner("Continuing your adventure..."):
-                    # Generate next scene
-                    next_scene = generate_next_scene(
-                        st.session_state.current_scene,
-                        chosen_choice,
-                        st.session_state.genre
-                    )
-                    
-                    # Update game state
-                    st.session_state.current_scene = next_scene
-                    st.session_state.story_log.append(("narrator", next_scene))
-                    st.session_state.choice_count += 1
-                    
-                    # Check if game should end
-                    if st.session_state.choice_count >= 20:
-                        st.session_state.game_over = True
-                    else:
-                        # Generate new choices
-                        new_choices = generate_choices(next_scene, st.session_state.genre)
-                        st.session_state.choices = new_choices
-                
-                st.rerun()
+        story_panel()
     
     # Game over screen
     elif st.session_state.game_over:
@@ -402,7 +2281,7 @@ def main():
         if "conclusion" not in st.session_state:
             conclusion_prompt = f"""
             Write a satisfying conclusion (about 200 words) to this {st.session_state.genre} story:
-            
+            {story_context(memory_context(st.session_state.memory))}
             {st.session_state.current_scene}
             
             Make it feel like a natural ending that wraps up the adventure for {st.session_state.player_name}.
@@ -410,32 +2289,37 @@ def main():
             """
             
             with st.spinner("আপনার অ্যাডভেঞ্চারের সমাপ্তি তৈরি করা হচ্ছে..."):  # Generating the conclusion to your adventure in Bengali
-                conclusion = generate_story(conclusion_prompt)
+                conclusion = generate_story(conclusion_prompt, prompt_type="conclusion")
                 st.session_state.conclusion = conclusion
                 st.session_state.story_log.append(("narrator", conclusion))
+                persist_game()
         
         # Display conclusion
         st.markdown('<div class="story-text">', unsafe_allow_html=True)
         st.write(st.session_state.conclusion)
         st.markdown('</div>', unsafe_allow_html=True)
         
-        # Compile full story
-        full_story = f"# {st.session_state.player_name}'s {st.session_state.genre.capitalize()} Adventure\n\n"
-        
-        for role, text in st.session_state.story_log:
-            if role == "player":
-                full_story += f"\n**{st.session_state.player_name} chose:** {text}\n\n"
-            else:
-                full_story += f"{text}\n\n"
-        
-        # Create download button for the story
+        # Export the finished story; each format is only built when it is picked
         st.markdown("### আপনার সম্পূর্ণ অ্যাডভেঞ্চার ডাউনলোড করুন")  # Download Your Complete Adventure in Bengali
-        st.markdown(get_download_link(full_story, f"{st.session_state.player_name}_{st.session_state.genre}_adventure.txt"), unsafe_allow_html=True)
+        fmt = st.radio("ফরম্যাট", list(EXPORT_FORMATS.keys()), format_func=lambda key: EXPORT_FORMATS[key][0], horizontal=True)  # Format in Bengali
+        label, extension, mime = EXPORT_FORMATS[fmt]
+        title = f"{st.session_state.player_name}'s {st.session_state.genre.capitalize()} Adventure"
+        story_id = st.session_state.get("game_token") or st.session_state.session_id
+        story_log = tuple(st.session_state.story_log)
+        player_name = st.session_state.player_name
+        # The bytes are built only when the player clicks (and then cached per story and format)
+        st.download_button(
+            f"Download your adventure story ({label})",
+            data=lambda: export_story(story_id, fmt, title, player_name, story_log),
+            file_name=f"{st.session_state.player_name}_{st.session_state.genre}_adventure.{extension}",
+            mime=mime
+        )
         
         # Option to play again
         if st.button("নতুন গল্প দিয়ে আবার খেলুন"):  # Play Again with a New Story in Bengali
             for key in list(st.session_state.keys()):
                 del st.session_state[key]
+            st.query_params.clear()
             st.rerun()
     
     # Footer
@@ -0,0 +1,282 @@
+"""Load-test the app against the local mock Gemini API.
+
+Simulates concurrent players through the whole game (opening, every decision and
+the conclusion) with Streamlit's AppTest, then reports per-turn latency
+percentiles and upstream calls and tokens per game. Results can be saved as a
+baseline and later runs compared against it.
+
+    python benchmark.py --players 8 --save benchmarks/baseline.json
+    python benchmark.py --players 8 --compare benchmarks/baseline.json
+
+--coldstart instead reports what a new container pays before the first page:
+the import time of app.py (with its slowest imports) and the first and a warm
+script run in a fresh process.
+
+    python benchmark.py --coldstart --save benchmarks/coldstart.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import urllib.request
+
+from streamlit.testing.v1 import AppTest
+
+import mock_gemini
+
+APP_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+NAME_LABEL = "আপনার নাম"
+START_LABEL = "আপনার অ্যাডভেঞ্চার শুরু করুন"
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def timed_run(element):
+    started = time.perf_counter()
+    element.run()
+    return time.perf_counter() - started
+
+# Function to play one full game and return the timings of each step
+def play_game(player, api_base, decisions, think_time, timeout, secrets):
+    at = AppTest.from_file(APP_FILE, default_timeout=timeout)
+    at.secrets["gemini"] = {"api_key": "benchmark", "api_base": api_base, **secrets.get("gemini", {})}
+    for section, values in secrets.items():
+        if section != "gemini":
+            at.secrets[section] = values
+    at.run()
+
+    result = {"start": None, "turns": [], "conclusion": None, "errors": 0}
+    next(t for t in at.text_input if t.label == NAME_LABEL).input(f"Player {player}")
+    result["start"] = timed_run(next(b for b in at.button if b.label == START_LABEL).click())
+
+    for decision in range(decisions):
+        if at.exception:
+            result["errors"] += 1
+            break
+        time.sleep(think_time)
+        # Alternate between the two choices so both branches get exercised; the key carries the decision index
+        choice_key = "choice1" if (player + decision) % 2 == 0 else "choice2"
+        button = next((b for b in at.button if (b.key or "").startswith(f"btn_{choice_key}_")), None)
+        if button is None:
+            result["errors"] += 1
+            break
+        elapsed = timed_run(button.click())
+        # The run that ends the game also produces the conclusion
+        if at.session_state["game_over"]:
+            result["conclusion"] = elapsed
+            break
+        result["turns"].append(elapsed)
+
+    result["errors"] += len(at.error) + len(at.exception)
+    return result
+
+def fetch_stats(api_base, reset=False):
+    root = api_base.rsplit("/v1beta", 1)[0]
+    if reset:
+        urllib.request.urlopen(urllib.request.Request(f"{root}/stats/reset", data=b"{}", method="POST")).read()
+        return None
+    with urllib.request.urlopen(f"{root}/stats") as response:
+        return json.loads(response.read())
+
+def run_benchmark(args):
+    server = None
+    api_base = args.api_base
+    if not api_base:
+        server = mock_gemini.server_from_args(args).start()
+        api_base = server.api_base
+    fetch_stats(api_base, reset=True)
+
+    secrets = json.loads(args.secrets) if args.secrets else {}
+    # Benchmarks measure generation, not saved games, unless a store is asked for explicitly
+    secrets.setdefault("session_store", {"backend": "none"})
+    # Every player process would fill its own opening pool, adding upstream calls no game made
+    secrets.setdefault("warm_pool", {"enabled": False})
+    # A fresh response cache per run, so results do not depend on earlier runs
+    cache_dir = tempfile.TemporaryDirectory(prefix="story-benchmark-")
+    secrets.setdefault("cache", {"path": os.path.join(cache_dir.name, "llm_cache.sqlite3")})
+
+    # One process per player: AppTest compiles the script with ast.parse, which is not thread-safe
+    started = time.perf_counter()
+    with cache_dir, ProcessPoolExecutor(max_workers=args.players, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = [executor.submit(play_game, player, api_base, args.decisions, args.think_time, args.timeout, secrets)
+                   for player in range(args.players)]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append({"start": None, "turns": [], "conclusion": None, "errors": 1, "failure": str(e)})
+    wall = time.perf_counter() - started
+
+    stats = fetch_stats(api_base)
+    if server is not None:
+        server.stop()
+
+    turns = [t for r in results for t in r["turns"]]
+    starts = [r["start"] for r in results if r["start"] is not None]
+    conclusions = [r["conclusion"] for r in results if r["conclusion"] is not None]
+    # Failed games made fewer calls, so per-game figures only count the games that finished cleanly
+    completed = sum(1 for r in results if not r["errors"])
+    games = max(1, completed)
+    return {
+        "players": args.players,
+        "completed_games": completed,
+        "decisions": args.decisions,
+        "wall_seconds": round(wall, 3),
+        "turn_p50": percentile(turns, 0.50),
+        "turn_p95": percentile(turns, 0.95),
+        "turn_p99": percentile(turns, 0.99),
+        "start_p50": percentile(starts, 0.50),
+        "start_p95": percentile(starts, 0.95),
+        "conclusion_p50": percentile(conclusions, 0.50),
+        "upstream_calls_per_game": stats["calls"] / games,
+        "tokens_per_game": (stats["prompt_tokens"] + stats["candidate_tokens"]) / games,
+        "prompt_tokens_per_game": stats["prompt_tokens"] / games,
+        "errors": sum(r["errors"] for r in results),
+        "failures": [r["failure"] for r in results if "failure" in r],
+        "note": "one process per player: request coalescing, rate limiting and caching are not shared across players",
+    }
+
+# Run in a fresh interpreter so nothing is imported or cached yet
+FIRST_PAINT_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+imported = time.perf_counter()
+at = AppTest.from_file(sys.argv[1], default_timeout=float(sys.argv[2]))
+for section, values in json.loads(sys.argv[3]).items():
+    at.secrets[section] = values
+at.run()
+painted = time.perf_counter()
+at.run()
+print(json.dumps({
+    "streamlit_import_seconds": imported - started,
+    "first_paint_seconds": painted - imported,
+    "warm_rerun_seconds": time.perf_counter() - painted,
+    "errors": len(at.exception),
+}))
+"""
+
+# Parse `python -X importtime` output into (seconds, module) for the modules app.py imports directly.
+# Children are printed before their parent, one indentation level deeper
+def parse_importtime(output, parent="app"):
+    pending = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0:
+            if name.strip() == parent:
+                return pending
+            pending = []
+        elif depth == 1:
+            pending.append((int(cumulative) / 1e6, name.strip()))
+    return []
+
+def app_import_seconds(output):
+    for line in output.splitlines():
+        if line.startswith("import time:") and line.rstrip().endswith("| app"):
+            return int(line.split("|")[1]) / 1e6
+    return None
+
+def coldstart_report(args):
+    directory = os.path.dirname(APP_FILE)
+    imported = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"], cwd=directory,
+                              capture_output=True, text=True, timeout=args.timeout)
+    imports = parse_importtime(imported.stderr)
+    app_import = app_import_seconds(imported.stderr)
+
+    secrets = json.loads(args.secrets) if args.secrets else {}
+    secrets.setdefault("gemini", {"api_key": "benchmark"})
+    secrets.setdefault("session_store", {"backend": "none"})
+    # The first page should not wait on background work that only a live server needs
+    secrets.setdefault("warm_pool", {"enabled": False})
+    secrets.setdefault("metrics", {"enabled": False})
+    painted = subprocess.run([sys.executable, "-c", FIRST_PAINT_SCRIPT, APP_FILE, str(args.timeout), json.dumps(secrets)],
+                             cwd=directory, capture_output=True, text=True, timeout=args.timeout)
+    try:
+        paint = json.loads(painted.stdout.strip().splitlines()[-1])
+    except (IndexError, ValueError):
+        paint = {"errors": 1, "failure": painted.stderr.strip()[-500:]}
+
+    slowest = sorted(imports, reverse=True)[:args.top]
+    return {
+        "app_import_seconds": app_import,
+        **paint,
+        "slowest_imports": [[name, round(seconds, 4)] for seconds, name in slowest],
+    }
+
+# Lower is better for every compared metric
+COMPARED_METRICS = ["turn_p50", "turn_p95", "turn_p99", "start_p50", "upstream_calls_per_game", "tokens_per_game",
+                    "app_import_seconds", "first_paint_seconds", "warm_rerun_seconds"]
+
+def compare(report, baseline, tolerance):
+    regressions = []
+    for metric in COMPARED_METRICS:
+        old, new = baseline.get(metric), report.get(metric)
+        if old is None or new is None:
+            continue
+        change = (new - old) / old if old else 0.0
+        flag = "REGRESSION" if change > tolerance else ""
+        print(f"  {metric:<26} {old:>10.3f} -> {new:>10.3f}  {change:+.1%} {flag}")
+        if flag:
+            regressions.append(metric)
+    return regressions
+
+def print_report(report):
+    for key, value in report.items():
+        if isinstance(value, float):
+            print(f"  {key:<26} {value:>10.3f}")
+        elif key == "slowest_imports":
+            print(f"  {key}:")
+            for name, seconds in value:
+                print(f"    {name:<36} {seconds:>8.3f}")
+        elif key != "failures" or value:
+            print(f"  {key:<26} {value}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the app against a mock Gemini API.")
+    parser.add_argument("--players", type=int, default=4, help="concurrent simulated players")
+    parser.add_argument("--decisions", type=int, default=20, help="decisions per game (the app ends after 20)")
+    parser.add_argument("--think-time", type=float, default=1.0, help="seconds a player reads before choosing")
+    parser.add_argument("--timeout", type=float, default=120.0, help="seconds allowed for a single script run")
+    parser.add_argument("--api-base", help="use an already running mock instead of starting one")
+    parser.add_argument("--secrets", help="extra secrets as JSON, e.g. '{\"prefetch\": {\"enabled\": false}}'")
+    parser.add_argument("--save", help="write the report to this baseline file")
+    parser.add_argument("--compare", help="compare against this baseline file")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="allowed relative slowdown before flagging")
+    parser.add_argument("--coldstart", action="store_true", help="report import time and first paint instead of load")
+    parser.add_argument("--top", type=int, default=10, help="slowest imports listed by --coldstart")
+    mock_gemini.add_arguments(parser)
+    args = parser.parse_args()
+
+    report = coldstart_report(args) if args.coldstart else run_benchmark(args)
+    print("Benchmark results:")
+    print_report(report)
+
+    if args.save:
+        directory = os.path.dirname(args.save)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved baseline to {args.save}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        print(f"Compared with {args.compare}:")
+        if compare(report, baseline, args.tolerance):
+            raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+"""Local stand-in for the Gemini API, for load tests that must not spend real quota.
+
+Implements generateContent and streamGenerateContent (SSE) with configurable
+latency, HTTP 500 and 429 rates, and malformed JSON answers. Call counts and
+token totals are available from GET /stats (POST /stats/reset clears them).
+
+    python mock_gemini.py --port 8765 --latency-mean 1.5 --error-rate 0.02
+
+Point the app at it with api_base = "http://127.0.0.1:8765/v1beta" under [gemini].
+"""
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+SCENE_SENTENCES = [
+    "অন্ধকার করিডোরে একটি ক্ষীণ আলো জ্বলে উঠল।",
+    "দূরে কোথাও একটি দরজা ধীরে ধীরে খুলে গেল।",
+    "বাতাসে পুরনো কাগজ আর বৃষ্টির গন্ধ ভেসে আসছিল।",
+    "হঠাৎ পায়ের নিচের মাটি কেঁপে উঠল।",
+    "একটি অচেনা কণ্ঠস্বর ফিসফিস করে নাম ধরে ডাকল।",
+    "সামনের পথ দুই ভাগে ভাগ হয়ে গেছে।",
+]
+CHOICES = [
+    "সাবধানে বাম দিকের পথ ধরে এগিয়ে যান",
+    "আলোর উৎস খুঁজতে ডান দিকে ছুটে যান",
+    "লুকিয়ে থেকে পরিস্থিতি পর্যবেক্ষণ করুন",
+    "সাহস করে অচেনা কণ্ঠস্বরের জবাব দিন",
+]
+
+def estimate_tokens(text):
+    return max(1, len(text) // 3)
+
+class MockGeminiServer:
+    def __init__(self, host="127.0.0.1", port=8765, latency_mean=1.0, latency_sigma=0.5,
+                 error_rate=0.0, rate_limit_rate=0.0, malformed_rate=0.0, stream_chunks=5, seed=None):
+        self.latency_mean = latency_mean
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.malformed_rate = malformed_rate
+        self.stream_chunks = stream_chunks
+        self.random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.reset_stats()
+        self.httpd = ThreadingHTTPServer((host, port), self._handler())
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def api_base(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1beta"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="mock-gemini", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats = {"calls": 0, "stream_calls": 0, "errors": 0, "rate_limited": 0, "malformed": 0,
+                          "prompt_tokens": 0, "candidate_tokens": 0, "by_model": {}}
+
+    def snapshot(self):
+        with self._lock:
+            return json.loads(json.dumps(self.stats))
+
+    # Log-normal latency whose mean is latency_mean seconds
+    def sample_latency(self):
+        if self.latency_mean <= 0:
+            return 0.0
+        mu = math.log(self.latency_mean) - self.latency_sigma ** 2 / 2
+        with self._lock:
+            return self.random.lognormvariate(mu, self.latency_sigma)
+
+    def roll(self, rate):
+        with self._lock:
+            return self.random.random() < rate
+
+    # Build an answer shaped like what the prompt asked for
+    def answer(self, prompt, generation_config):
+        with self._lock:
+            sentences = self.random.sample(SCENE_SENTENCES, 4)
+            choice1, choice2 = self.random.sample(CHOICES, 2)
+        scene = " ".join(sentences)
+        if "[[NAME]]" in prompt:
+            scene = "[[NAME]] " + scene
+        if generation_config.get("responseSchema"):
+            return json.dumps({"scene": scene, "choice1": choice1, "choice2": choice2}, ensure_ascii=False), True
+        if '"choice1"' in prompt:
+            return json.dumps({"choice1": choice1, "choice2": choice2}, ensure_ascii=False), True
+        return scene, False
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, status, body, headers=None):
+                data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if urlparse(self.path).path == "/stats":
+                    self._send_json(200, server.snapshot())
+                else:
+                    self._send_json(404, {"error": {"message": "not found"}})
+
+            def do_POST(self):
+                path = urlparse(self.path).path
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0) or 0))
+                if path == "/stats/reset":
+                    server.reset_stats()
+                    self._send_json(200, {})
+                    return
+
+                match = re.fullmatch(r"/v1beta/models/([^/:]+):(generateContent|streamGenerateContent)", path)
+                if not match:
+                    self._send_json(404, {"error": {"message": "not found"}})
+                    return
+                model, method = match.groups()
+                stream = method == "streamGenerateContent"
+
+                request = json.loads(body or b"{}")
+                prompt = "".join(part.get("text", "") for content in request.get("contents", [])
+                                 for part in content.get("parts", []))
+                generation_config = request.get("generationConfig", {})
+
+                with server._lock:
+                    server.stats["calls"] += 1
+                    server.stats["stream_calls"] += int(stream)
+                    server.stats["by_model"][model] = server.stats["by_model"].get(model, 0) + 1
+
+                latency = server.sample_latency()
+                if server.roll(server.rate_limit_rate):
+                    time.sleep(latency * 0.1)
+                    with server._lock:
+                        server.stats["rate_limited"] += 1
+                    self._send_json(429, {"error": {"code": 429, "message": "Resource has been exhausted"}},
+                                    headers={"Retry-After": "1"})
+                    return
+                if server.roll(server.error_rate):
+                    time.sleep(latency)
+                    with server._lock:
+                        server.stats["errors"] += 1
+                    self._send_json(500, {"error": {"code": 500, "message": "Internal error"}})
+                    return
+
+                text, is_json = server.answer(prompt, generation_config)
+                if is_json and server.roll(server.malformed_rate):
+                    # Cut the JSON short so the app's parser has to fall back
+                    text = text[:len(text) // 2]
+                    with server._lock:
+                        server.stats["malformed"] += 1
+
+                usage = {"promptTokenCount": estimate_tokens(prompt), "candidatesTokenCount": estimate_tokens(text)}
+                usage["totalTokenCount"] = usage["promptTokenCount"] + usage["candidatesTokenCount"]
+                with server._lock:
+                    server.stats["prompt_tokens"] += usage["promptTokenCount"]
+                    server.stats["candidate_tokens"] += usage["candidatesTokenCount"]
+
+                if stream:
+                    self._stream(text, usage, latency)
+                else:
+                    time.sleep(latency)
+                    self._send_json(200, {
+                        "candidates": [{"content": {"parts": [{"text": text}], "role": "model"}, "finishReason": "STOP"}],
+                        "usageMetadata": usage,
+                    })
+
+            def _write_chunk(self, data):
+                self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+                self.wfile.flush()
+
+            # Send the answer as SSE events in a chunked body, like the real API:
+            # the first after a share of the latency, the rest spread over it
+            def _stream(self, text, usage, latency):
+                count = max(1, server.stream_chunks)
+                size = math.ceil(len(text) / count)
+                chunks = [text[i:i + size] for i in range(0, len(text), size)] or [""]
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                time.sleep(latency * 0.3)
+                for i, chunk in enumerate(chunks):
+                    event = {"candidates": [{"content": {"parts": [{"text": chunk}], "role": "model"}}]}
+                    if i == len(chunks) - 1:
+                        event["candidates"][0]["finishReason"] = "STOP"
+                        event["usageMetadata"] = usage
+                    self._write_chunk(f"data: {json.dumps(event, ensure_ascii=False)}\r\n\r\n".encode("utf-8"))
+                    if i < len(chunks) - 1:
+                        time.sleep(latency * 0.7 / len(chunks))
+                self.wfile.write(b"0\r\n\r\n")
+                self.wfile.flush()
+
+        return Handler
+
+def add_arguments(parser):
+    parser.add_argument("--latency-mean", type=float, default=1.0, help="mean response latency in seconds")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="log-normal shape; larger means a longer tail")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with HTTP 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="share of requests answered with HTTP 429")
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="share of JSON answers that are cut short")
+    parser.add_argument("--seed", type=int, default=None, help="random seed for reproducible runs")
+
+def server_from_args(args, host="127.0.0.1", port=0):
+    return MockGeminiServer(host=host, port=port, latency_mean=args.latency_mean, latency_sigma=args.latency_sigma,
+                            error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate,
+                            malformed_rate=args.malformed_rate, seed=args.seed)
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local mock of the Gemini API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    server = server_from_args(args, args.host, args.port)
+    print(f"Mock Gemini API listening on {server.api_base}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""Precompile branching story trees for the app's static mode.
+
+Expands every genre (or the ones given with --genre) into a full binary tree of
+scenes and choices up to --depth decisions, using the same generation functions
+as the app. Finished nodes are appended to a checkpoint file, so an interrupted
+run picks up where it stopped when started again.
+
+    python precompile.py --depth 4 --workers 8 --out story_trees
+"""
+import argparse
+import json
+import logging
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import app
+
+logger = logging.getLogger("precompile")
+
+# Load the nodes finished by earlier runs, keyed by their choice path ("" is the opening, "12" = choice1 then choice2)
+def load_checkpoint(path):
+    nodes = {}
+    if not os.path.exists(path):
+        return nodes
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                node = json.loads(line)
+            except ValueError:
+                # A run killed mid-write leaves at most one truncated line
+                continue
+            nodes[node["path"]] = node
+    return nodes
+
+# Function to generate one node of the tree
+def generate_node(genre, path, parent):
+    if parent is None:
+        opening = app.generate_placeholder_opening(genre)
+        if opening is None:
+            raise app.GeminiError("Opening scene could not be generated")
+        scene, choices = opening
+    else:
+        chosen_choice = parent["choices"][f"choice{path[-1]}"]
+        # A scene without the placeholder may carry an invented name that fill_name never replaces
+        scene = app.generate_placeholder_scene(parent["scene"], chosen_choice, genre)
+        if scene is None:
+            raise app.GeminiError("Scene could not be generated with the name placeholder")
+        choices = app.generate_choices(scene, genre)
+
+    # Fallback choices mean the model's answer was unusable; leave the node for the next run
+    if choices == app.FALLBACK_CHOICES:
+        raise app.GeminiError("Choices could not be generated")
+    return {"path": path, "scene": scene, "choices": choices}
+
+# Function to expand one genre's tree, generating independent branches in parallel
+def compile_genre(genre, depth, workers, out_dir):
+    checkpoint_path = os.path.join(out_dir, f"{genre}.checkpoint.jsonl")
+    nodes = load_checkpoint(checkpoint_path)
+    failures = 0
+    logger.info("%s: resuming with %d nodes", genre, len(nodes))
+
+    with open(checkpoint_path, "a", encoding="utf-8") as checkpoint, \
+            ThreadPoolExecutor(max_workers=workers, thread_name_prefix="precompile") as executor:
+        pending = {}
+
+        def schedule(path):
+            if path in nodes or path in pending.values():
+                return
+            parent = nodes.get(path[:-1]) if path else None
+            if path and parent is None:
+                return
+            pending[executor.submit(generate_node, genre, path, parent)] = path
+
+        def expand(path):
+            if len(path) < depth:
+                schedule(path + "1")
+                schedule(path + "2")
+
+        schedule("")
+        for path in list(nodes):
+            expand(path)
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                try:
+                    node = future.result()
+                except Exception as e:
+                    failures += 1
+                    logger.warning("%s: node '%s' failed: %s", genre, path, e)
+                    continue
+                nodes[path] = node
+                checkpoint.write(json.dumps(node, ensure_ascii=False) + "\n")
+                checkpoint.flush()
+                expand(path)
+
+    # Breadth-first order puts the opening first; missing subtrees become the live frontier
+    ordered = sorted(nodes.values(), key=lambda node: (len(node["path"]), node["path"]))
+    if not ordered:
+        logger.error("%s: nothing to write", genre)
+        return False
+    app.write_story_tree(app.story_tree_path(genre, out_dir), ordered)
+    expected = 2 ** (depth + 1) - 1
+    logger.info("%s: wrote %d/%d nodes (%d failed this run)", genre, len(ordered), expected, failures)
+    return len(ordered) == expected
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompile branching story trees for static mode.")
+    parser.add_argument("--genre", action="append", choices=list(app.GENRE_OPTIONS.keys()),
+                        help="genre to compile (repeatable, default: all)")
+    parser.add_argument("--depth", type=int, default=3, help="number of decisions to precompile")
+    parser.add_argument("--workers", type=int, default=4, help="parallel generation workers")
+    parser.add_argument("--out", default=app.app_path("story_trees"), help="output directory")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    depth = max(0, min(args.depth, app.MAX_DECISIONS))
+    os.makedirs(args.out, exist_ok=True)
+
+    complete = True
+    for genre in args.genre or list(app.GENRE_OPTIONS.keys()):
+        complete = compile_genre(genre, depth, args.workers, args.out) and complete
+    if not complete:
+        logger.warning("Some trees are incomplete; run the same command again to resume")
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()